@@ -0,0 +1,128 @@
+"""
+    Persistent catalog of the channels of a data source, indexed by segment. For every channel it keeps its sample
+    rate, unit and its status in every segment that was processed: present, missing, constant, all NaN or failing to
+    decode. Runs select their channels from the catalog instead of discovering them, and skip channels that are known
+    to be unusable without reading their data.
+"""
+
+import os
+from fnmatch import fnmatch
+
+import h5py
+import numpy as np
+
+from application.config import config_manager
+from application.model.channel import Channel
+
+LOG = config_manager.get_logger(__name__)
+
+
+class ChannelCatalog:
+
+    UNKNOWN = 0
+    PRESENT = 1
+    CONSTANT = 2
+    ALL_NAN = 3
+    MISSING = 4
+    DECODE_FAILURE = 5
+    FAILED = 6
+    DISCARDED = (MISSING, DECODE_FAILURE, FAILED)  # a run discards channels with any of these
+
+    def __init__(self, file):
+        self.file = file
+        self.names = []
+        self.f_sample = []
+        self.units = []
+        self.index = {}
+        self.segments = []
+        self.segment_index = {}
+        self.status = np.zeros((0, 0), dtype=np.uint8)
+        if os.path.isfile(self.file):
+            self._load()
+            LOG.info(f'Loaded catalog of {len(self.names)} channels in {len(self.segments)} segments from {self.file}')
+
+    def _load(self):
+        with h5py.File(self.file, 'r') as h5f:
+            self.names = list(h5f['names'].asstr()[()])
+            self.f_sample = [None if np.isnan(f) else float(f) for f in h5f['f_sample'][()]]
+            self.units = [u or None for u in h5f['units'].asstr()[()]]
+            self.segments = [tuple(s) for s in h5f['segments'][()].tolist()]
+            self.status = h5f['status'][()]
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.segment_index = {segment: i for i, segment in enumerate(self.segments)}
+
+    def save(self):
+        """the catalog is written under a temporary name first, so that a crash never corrupts it"""
+        os.makedirs(os.path.dirname(self.file), exist_ok=True)
+        tmp_file = self.file + '.tmp'
+        with h5py.File(tmp_file, 'w') as h5f:
+            h5f.create_dataset('names', data=self.names, dtype=h5py.string_dtype())
+            h5f.create_dataset('f_sample', data=[np.nan if f is None else f for f in self.f_sample], dtype=float)
+            h5f.create_dataset('units', data=[u or '' for u in self.units], dtype=h5py.string_dtype())
+            h5f.create_dataset('segments', data=np.array(self.segments, dtype=float).reshape(-1, 2))
+            h5f.create_dataset('status', data=self.status)
+        os.replace(tmp_file, self.file)
+
+    @staticmethod
+    def _segment_key(segment):
+        return float(segment[0]), float(segment[1])
+
+    def add_channels(self, channels):
+        """adds channels (Channel objects or names) that are not in the catalog yet"""
+        new = [c for c in channels if str(c) not in self.index]
+        for channel in new:
+            self.index[str(channel)] = len(self.names)
+            self.names.append(str(channel))
+            self.f_sample.append(getattr(channel, 'f_sample', None))
+            self.units.append(getattr(channel, 'unit', None))
+        if new:
+            self.status = np.pad(self.status, ((0, len(new)), (0, 0)))
+
+    def set_status(self, segment, statuses):
+        """
+        :param segment: (gps_start, gps_end)
+        :param statuses: {channel (name): status}
+        """
+        self.add_channels(statuses)
+        key = self._segment_key(segment)
+        if key not in self.segment_index:
+            self.segment_index[key] = len(self.segments)
+            self.segments.append(key)
+            self.status = np.pad(self.status, ((0, 0), (0, 1)))
+        rows = [self.index[str(channel)] for channel in statuses]
+        self.status[rows, self.segment_index[key]] = list(statuses.values())
+
+    def get_unknown_segments(self, segments):
+        """segments of which the channels have not been discovered yet"""
+        return [segment for segment in segments if self._segment_key(segment) not in self.segment_index]
+
+    def add_segment_channels(self, segment, channels):
+        """adds the channels found in the data of a segment, their status there is unknown until it is processed"""
+        self.add_channels(channels)
+        self.set_status(segment, {str(channel): self.UNKNOWN for channel in channels})
+
+    def get_channels(self, segments, f_target=None, exclude_patterns=None):
+        """
+        selects the channels for a run over segments. Channels that were discarded in any of the segments, or that
+        only ever held NaN, are left out since they would be discarded anyway.
+
+        :param segments: segments of the run, or None to select all channels regardless of their status
+        :return: list of Channel
+        """
+        dead = np.zeros(len(self.names), dtype=bool)
+        columns = [self.segment_index[k] for k in map(self._segment_key, segments or []) if k in self.segment_index]
+        if columns:
+            status = self.status[:, columns]
+            known = (status != self.UNKNOWN).all(axis=1)
+            dead = np.isin(status, self.DISCARDED).any(axis=1) | (known & (status == self.ALL_NAN).all(axis=1))
+            if dead.any():
+                LOG.info(f'Skipping {dead.sum()} channels that are known to be unusable.')
+
+        channels = [Channel(name=name, f_sample=f_sample, unit=unit)
+                    for name, f_sample, unit, is_dead in zip(self.names, self.f_sample, self.units, dead)
+                    if not is_dead]
+        if f_target:
+            channels = [c for c in channels if c.f_sample is None or c.f_sample == f_target]
+        if exclude_patterns:
+            channels = [c for c in channels if not any(fnmatch(c.name, p) for p in exclude_patterns)]
+        return channels
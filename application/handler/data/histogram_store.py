@@ -0,0 +1,139 @@
+"""
+    On-disk store for histograms, with one .h5 file per segment. Segments that are already stored with the same
+    settings do not have to be processed again and only the rows of the requested keys are read when loading.
+"""
+
+import os
+
+import h5py
+import numpy as np
+
+from application.config import config_manager
+from application.model.histogram import HistBank
+
+LOG = config_manager.get_logger(__name__)
+
+
+class HistogramStore:
+
+    FILE_TEMPLATE = 'histograms_gs{gps_start}_ge{gps_end}.h5'
+    KEY_SEPARATOR = '|'
+    DISCARDED = 'discarded'
+    SETTINGS = 'settings'
+
+    def __init__(self, path, settings=None):
+        """
+        :param path: directory of the histogram files
+        :param settings: hash of the settings the histograms were made with, other than those in path. Stored
+            histograms with different settings are made again.
+        """
+        self.path = path
+        self.settings = settings
+        os.makedirs(self.path, exist_ok=True)
+        LOG.info(f'Storing histograms at {self.path}')
+
+    def get_file(self, segment):
+        gps_start, gps_end = segment
+        return self.path + self.FILE_TEMPLATE.format(gps_start=int(gps_start), gps_end=int(gps_end))
+
+    @classmethod
+    def encode_key(cls, key):
+        return cls.KEY_SEPARATOR.join(str(k) for k in key)
+
+    def is_stored(self, segment, keys):
+        """
+        checks if the histograms of a segment are stored with the same settings for all keys, except for keys of
+        channels that were discarded in that segment.
+
+        :param segment: (gps_start, gps_end)
+        :param keys: {bank name: keys of that bank}
+        """
+        file = self.get_file(segment)
+        if not os.path.isfile(file):
+            return False
+
+        try:
+            with h5py.File(file, 'r') as h5f:
+                if self.settings is not None and h5f.attrs.get(self.SETTINGS) != self.settings:
+                    return False
+                discarded = set(h5f[self.DISCARDED].asstr()[()])
+                for name, bank_keys in keys.items():
+                    stored = set(h5f[name]['keys'].asstr()[()])
+                    if any(self.encode_key(k) not in stored and str(k[0]) not in discarded for k in bank_keys):
+                        return False
+        except (OSError, KeyError) as e:
+            LOG.warning(f'Unable to read stored histograms from {file}: {e}')
+            return False
+        return True
+
+    def write(self, segment, banks, discarded):
+        """
+        writes the histograms of a single segment. The file is written under a temporary name first, so that a
+        crash never leaves a partially written segment behind.
+
+        :param segment: (gps_start, gps_end)
+        :param banks: {bank name: HistBank}
+        :param discarded: channels that were discarded in this segment
+        """
+        file = self.get_file(segment)
+        tmp_file = file + '.tmp'
+        with h5py.File(tmp_file, 'w') as h5f:
+            if self.settings is not None:
+                h5f.attrs[self.SETTINGS] = self.settings
+            h5f.create_dataset(self.DISCARDED, data=[str(c) for c in discarded], dtype=h5py.string_dtype())
+            for name, bank in banks.items():
+                self._write_bank(h5f.create_group(name), bank)
+        os.replace(tmp_file, file)
+
+    def _write_bank(self, group, bank: HistBank):
+        """only the non-zero bins are stored, in compressed sparse row format"""
+        keys = list(bank.keys())
+        rows = bank.rows(keys)
+        indptr, bins, values = bank.sparse_counts(rows)
+
+        group.attrs['l2_nbin'] = bank.l2_nbin
+        group.create_dataset('keys', data=[self.encode_key(k) for k in keys], dtype=h5py.string_dtype())
+        for field in HistBank.FIELDS:
+            group.create_dataset(field, data=getattr(bank, field)[rows])
+        group.create_dataset('indptr', data=indptr)
+        group.create_dataset('bins', data=bins.astype(np.min_scalar_type(bank.nbin - 1)))
+        group.create_dataset('values', data=values)
+
+    def load(self, segments, name, keys, l2_nbin=12, compact=False):
+        """
+        merges the stored histograms of the given keys over the given segments. Only the rows of these keys are read.
+
+        :param compact: build the bank compact and merge the stored histograms in that form, for banks with few points
+        :return: merged HistBank, set of (names of) channels that were discarded in any of the segments
+        """
+        bank = HistBank(keys, l2_nbin=l2_nbin, compact=compact)
+        encoded = {self.encode_key(k): k for k in keys}
+        discarded = set()
+        for segment in segments:
+            with h5py.File(self.get_file(segment), 'r') as h5f:
+                discarded.update(h5f[self.DISCARDED].asstr()[()])
+                bank += self._read_bank(h5f[name], encoded, compact=compact)
+        return bank, discarded
+
+    @staticmethod
+    def _read_bank(group, encoded, compact=False):
+        stored_keys = group['keys'].asstr()[()]
+        rows = np.flatnonzero(np.isin(stored_keys, list(encoded)))
+
+        segment_bank = HistBank([encoded[k] for k in stored_keys[rows]], l2_nbin=int(group.attrs['l2_nbin']),
+                                compact=compact)
+        for field in HistBank.FIELDS:
+            getattr(segment_bank, field)[:] = group[field][()][rows]
+
+        if not rows.size:
+            return segment_bank
+
+        indptr = group['indptr'][()]
+        start, stop = indptr[rows], indptr[rows + 1]
+        if rows.size == stored_keys.size:
+            bins, values = group['bins'][()], group['values'][()]
+        else:
+            bins = np.concatenate([group['bins'][i:j] for i, j in zip(start, stop)])
+            values = np.concatenate([group['values'][i:j] for i, j in zip(start, stop)])
+        segment_bank.set_sparse_counts(np.concatenate(([0], np.cumsum(stop - start))), bins, values)
+        return segment_bank
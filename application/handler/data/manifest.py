@@ -0,0 +1,95 @@
+"""
+    Manifest of the files written by the Resampler. Every completed output file is recorded with its GPS range,
+    downsampling method, target frequency, size and checksum, so that a rerun only has to process the segments whose
+    files are missing or invalid.
+"""
+
+import hashlib
+import json
+import os
+
+from application.config import config_manager
+
+LOG = config_manager.get_logger(__name__)
+
+
+class DecimationManifest:
+
+    FILE = 'manifest.jsonl'
+    CHUNK_SIZE = 2 ** 20
+
+    def __init__(self, path, verify=False):
+        """
+        :param path: directory of the output files
+        :param verify: check the checksum of every recorded file instead of only its size
+        """
+        self.path = path
+        self.file = self.path + self.FILE
+        self.verify = verify
+        self.entries = self._load()
+
+    def _load(self):
+        """the manifest is only ever appended to, later entries of a file replace earlier ones and removed files are
+        dropped. A line that was cut off by a crash is skipped."""
+        entries = {}
+        if os.path.isfile(self.file):
+            with open(self.file, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if entry.get('removed'):
+                        entries.pop(entry['file'], None)
+                    else:
+                        entries[entry['file']] = entry
+        return entries
+
+    @classmethod
+    def checksum(cls, file):
+        sha = hashlib.sha256()
+        with open(file, 'rb') as f:
+            for chunk in iter(lambda: f.read(cls.CHUNK_SIZE), b''):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def is_valid(self, file, segment, method, f_target):
+        """checks if file was completed for segment with the same settings and has not changed since"""
+        entry = self.entries.get(os.path.basename(file))
+        if entry is None or not os.path.isfile(file):
+            return False
+        if (entry['gps_start'], entry['gps_end']) != tuple(float(t) for t in segment) \
+                or entry['method'] != method or entry['f_target'] != f_target:
+            return False
+        if os.path.getsize(file) != entry['size']:
+            LOG.warning(f'Size of {file} does not match the manifest.')
+            return False
+        if self.verify and self.checksum(file) != entry['checksum']:
+            LOG.warning(f'Checksum of {file} does not match the manifest.')
+            return False
+        return True
+
+    def add(self, file, segment, method, f_target):
+        """records a completed file, which must have its final name already"""
+        entry = {
+            'file': os.path.basename(file),
+            'gps_start': float(segment[0]),
+            'gps_end': float(segment[1]),
+            'method': method,
+            'f_target': f_target,
+            'size': os.path.getsize(file),
+            'checksum': self.checksum(file),
+        }
+        self._append(entry)
+        self.entries[entry['file']] = entry
+
+    def remove(self, file):
+        """records that a file was deleted"""
+        self._append({'file': os.path.basename(file), 'removed': True})
+        self.entries.pop(os.path.basename(file), None)
+
+    def _append(self, entry):
+        with open(self.file, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
@@ -3,9 +3,11 @@
 """
 
 
+import math
 import os
 
 from application.config import config_manager
+from application.model.channel import DataBlock
 from resources.constants import RESOURCE_DIR
 
 LOG = config_manager.get_logger(__name__)
@@ -30,6 +32,37 @@ class BaseReader:
             self.cache.close()
             self.cache = None
 
+    def prefetch(self, request_segment, channels):
+        """reads the data of several channels at once, if the reader benefits from it"""
+        pass
+
+    def iter_blocks(self, request_segment, channel, block_duration=None):
+        """
+        yields the data of a channel in request_segment as blocks of block_duration seconds, so that only a single
+        block has to be held in memory at a time. Blocks never span multiple files, without block_duration every
+        block holds all the data of one file.
+
+        :return: generator of DataBlock(data, gps_start, contiguous), where contiguous tells if the block continues
+        the previous block without a gap
+        """
+        t_previous = None
+        for gps_start, f_sample, n_samples, read in self._iter_sources(request_segment, channel):
+            block_size = n_samples if block_duration is None else max(int(round(block_duration * f_sample)), 1)
+            for i in range(0, n_samples, block_size):
+                t_block = gps_start + i / f_sample
+                data = read(i, min(i + block_size, n_samples))
+                yield DataBlock(data, t_block, t_previous is not None and math.isclose(t_block, t_previous))
+                t_previous = t_block + data.size / f_sample
+
+    def get_segment_channels(self, segment):
+        """all channels in the data of segment, including excluded channels"""
+        raise NotImplementedError
+
+    def _iter_sources(self, request_segment, channel):
+        """yields (gps_start, f_sample, n_samples, read) for each file that overlaps request_segment, where read(i, j)
+        returns samples i to j of the overlap"""
+        raise NotImplementedError
+
     def _check_path_exists(self, file_loc, file):
         if not os.path.isfile(file):
             file = self.default_path + file_loc + file
@@ -15,7 +15,9 @@ class CSVReader(BaseReader):
     def __init__(self):
         super(CSVReader, self).__init__(gps_start=None, gps_end=None, exclude_patterns=None)
 
-    def load_csv(self, csv_file, usecols=None) -> pd.DataFrame:
+    def locate(self, csv_file):
         csv_file = check_extension(csv_file, extension='.csv')
-        csv_file = self._check_path_exists(file_loc=self.CSV_DIR, file=csv_file)
-        return pd.read_csv(csv_file, usecols=usecols)
+        return self._check_path_exists(file_loc=self.CSV_DIR, file=csv_file)
+
+    def load_csv(self, csv_file, usecols=None) -> pd.DataFrame:
+        return pd.read_csv(self.locate(csv_file), usecols=usecols)
@@ -2,11 +2,12 @@
     File reader for Virgo Frame Files. Loads data by concatenating different segments.
 """
 
+from collections import defaultdict
 from fnmatch import fnmatch
 
 import numpy as np
 from ligo import segments
-from virgotools.frame_lib import FrameFile
+from virgotools.frame_lib import FrameFile, FrVect2array
 
 from application.config import config_manager
 from application.model.channel import Channel, ChannelSegment
@@ -16,6 +17,19 @@ from .base import BaseReader
 LOG = config_manager.get_logger(__name__)
 
 
+def adc_to_array(adc):
+    """data of an ADC in a frame, with its slope and bias applied"""
+    data = FrVect2array(adc.contents.data)
+    slope = adc.contents.slope
+    bias = adc.contents.bias
+    if slope != 1:
+        data = data.astype(np.float64, copy=False)
+        data *= slope
+    if bias != 0:
+        data += bias
+    return data
+
+
 class FrameFileReader(BaseReader):
 
     FFL_DIR = '/virgoData/ffl/'
@@ -27,6 +41,8 @@ class FrameFileReader(BaseReader):
         self.records = self._get_records(self.source)
         self.files = [str(f) for f in self.records.file]
         self.segments = self._get_segments()
+        self.prefetched = {}
+        self.prefetched_segment = None
 
     def _get_records(self, file):
         records = np.loadtxt(file, dtype=self.RECORD_STRUCTURE)
@@ -54,7 +70,68 @@ class FrameFileReader(BaseReader):
             frame = ff.getChannel(channel.name, *segment)
         return frame.data
 
-    def get_available_channels(self, t0=None, f_target=None) -> [Channel]:
+    @staticmethod
+    def get_channels_data(gwf_file, segment, channels=None, as_block=False, file_start=None):
+        """
+        extracts several channels from a frame file in a single pass over its frames, instead of opening and decoding
+        the file once per channel. Frames are taken to follow each other from the start of the file, the samples of
+        the first frame before the start of segment are dropped.
+
+        :param channels: channels (or channel names) to extract, all ADCs if None
+        :param as_block: return a 2-D (channel, sample) array in the order of channels instead of a mapping, the
+        channels must share a sample rate
+        :param file_start: GPS start of the file, by default the segment is taken to start at a frame
+        :return: {channel name: data} or 2-D array
+        """
+        t_start, t_stop = segment
+        file_start = t_start if file_start is None else file_start
+        wanted = None if channels is None else [str(c) for c in channels]
+        wanted_set = None if wanted is None else set(wanted)
+        frames = defaultdict(list)
+        with FrameFile(gwf_file) as ff:
+            t = t_start
+            while t < t_stop:
+                frame_duration = None
+                with ff.get_frame(t) as f:
+                    for adc in f.iter_adc():
+                        name = str(adc.contents.name)
+                        if wanted_set is None or name in wanted_set:
+                            data = adc_to_array(adc)
+                            f_sample = adc.contents.sampleRate
+                            frame_duration = data.size / f_sample
+                            t_frame = file_start + (t - file_start) // frame_duration * frame_duration
+                            i_start = int(round((t - t_frame) * f_sample))
+                            i_stop = int(round((min(t_frame + frame_duration, t_stop) - t_frame) * f_sample))
+                            frames[name].append(data[i_start:i_stop])
+                if frame_duration is None:
+                    break
+                t = t_frame + frame_duration
+
+        data = {name: np.concatenate(frames[name]) for name in (wanted if wanted is not None else frames)
+                if name in frames}
+        if as_block:
+            return np.stack(list(data.values()))
+        return data
+
+    def prefetch(self, request_segment, channels):
+        """
+        reads the data of channels in request_segment in one pass per frame file, after which the data of these
+        channels is served from memory until the next prefetch. Only the data of a single prefetch is held, so
+        channels should be prefetched in batches to bound the memory that is used.
+        """
+        self.prefetched = defaultdict(list)
+        for seg in segments.segmentlist([request_segment]) & self.segments:
+            i_segment = self.segments.find(seg)
+            for name, data in self.get_channels_data(gwf_file=self.files[i_segment], segment=seg, channels=channels,
+                                                     file_start=self.segments[i_segment][0]).items():
+                self.prefetched[name].append((seg, data))
+        self.prefetched_segment = request_segment
+
+    def _reset_cache(self):
+        self.prefetched = {}
+        self.prefetched_segment = None
+
+    def get_available_channels(self, t0=None, f_target=None, exclude=True) -> [Channel]:
         t0 = t0 if t0 else self.gps_start
         with FrameFile(self.source).get_frame(t0) as f:
             channels = [Channel(name=str(adc.contents.name),
@@ -62,10 +139,13 @@ class FrameFileReader(BaseReader):
                         for adc in f.iter_adc()]
             if f_target:
                 channels = [c for c in channels if c.f_sample == f_target]
-            if self.exclude_patterns:
+            if exclude and self.exclude_patterns:
                 channels = [c for c in channels if not any(fnmatch(c.name, p) for p in self.exclude_patterns)]
             return channels
 
+    def get_segment_channels(self, segment):
+        return self.get_available_channels(t0=segment[0], exclude=False)
+
     def get_data_from_segments(self, request_segment, channel):
         request_segments = segments.segmentlist([request_segment]) & self.segments
 
@@ -77,3 +157,25 @@ class FrameFileReader(BaseReader):
             all_data.append(channel_data)
 
         return np.concatenate(all_data)
+
+    def _iter_sources(self, request_segment, channel):
+        if request_segment == self.prefetched_segment and channel.name in self.prefetched:
+            for seg, data in self.prefetched[channel.name]:
+
+                def read(i, j, data=data):
+                    return data[i:j]
+
+                yield seg[0], channel.f_sample, data.size, read
+            return
+
+        request_segments = segments.segmentlist([request_segment]) & self.segments
+
+        for seg in request_segments:
+            i_segment = self.segments.find(seg)
+            f_sample = channel.f_sample
+            with FrameFile(self.files[i_segment]) as ff:
+
+                def read(i, j, ff=ff, t_start=seg[0]):
+                    return ff.getChannel(channel.name, t_start + i / f_sample, t_start + j / f_sample).data
+
+                yield seg[0], f_sample, int(round(abs(seg) * f_sample)), read
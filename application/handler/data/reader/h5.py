@@ -3,6 +3,7 @@
 """
 
 import os
+from collections import OrderedDict
 from fnmatch import fnmatch
 
 import h5py
@@ -21,9 +22,14 @@ class H5Reader(BaseReader):
 
     H5_DIR = 'ds_data/data/'
     H5 = '.h5'
+    MAX_OPEN_FILES = 16
 
     def __init__(self, gps_start, gps_end, exclude_patterns=None):
         super(H5Reader, self).__init__(gps_start, gps_end, exclude_patterns)
+        self.cache = OrderedDict()
+        self.channels = {}
+        self.shapes = {}
+        self.plans = {}
         self.records = self._get_records(loc=self.default_path + self.H5_DIR, ext=self.H5)
         self.files = [str(f) for f in self.records.file]
         self.segments = self._get_segments()
@@ -45,46 +51,188 @@ class H5Reader(BaseReader):
         )
 
     def load(self, file, channel=None):
+        """
+        returns an open handle of file. Up to MAX_OPEN_FILES handles are kept open, the least recently used handle is
+        closed when another file has to be opened. The channels and dataset shapes of a file are cached, also after
+        its handle is closed, so that they never have to be read again.
+
+        :raise KeyError: if channel is given and not in the file
+        """
         if self.records.size == 0:
             LOG.error(f'No data found from {self.gps_start} to {self.gps_end} in {RESOURCE_DIR + self.H5_DIR}')
             exit_on_error()
-        if not self.cache:
-            file = check_extension(file, extension=self.H5)
-            file = self._check_path_exists(file_loc=self.H5_DIR, file=file)
+        if file not in self.cache:
+            path = check_extension(file, extension=self.H5)
+            path = self._check_path_exists(file_loc=self.H5_DIR, file=path)
             try:
-                self.cache = h5py.File(file, 'r')
+                h5f = h5py.File(path, 'r')
             except OSError as e:
-                LOG.error(f'Exception caught while trying to load {file}: {e}')
-                LOG.info(f'The HDF5 file {file} might have corrupted, try resampling the data.')
+                LOG.error(f'Exception caught while trying to load {path}: {e}')
+                LOG.info(f'The HDF5 file {path} might have corrupted, try resampling the data.')
                 exit_on_error()
-        elif channel not in self.cache:
-            self._reset_cache()
-            self.load(file, channel)
+            if len(self.cache) >= self.MAX_OPEN_FILES:
+                _, oldest = self.cache.popitem(last=False)
+                oldest.close()
+            self.cache[file] = h5f
+            if file not in self.channels:
+                self.channels[file] = dict.fromkeys(self._get_group(h5f).keys())  # ordered, with fast lookup
+        self.cache.move_to_end(file)
+
+        if channel is not None and channel not in self.get_channels(file):
+            raise KeyError(f'{channel} not found in {file}')
+        return self.cache[file]
+
+    def get_channels(self, file):
+        if file not in self.channels:
+            self.load(file)
+        return self.channels[file]
+
+    def get_shape(self, file, channel):
+        if (file, channel) not in self.shapes:
+            self.shapes[file, channel] = self.get_channel_from_file(file, channel).shape
+        return self.shapes[file, channel]
+
+    def _reset_cache(self):
+        for h5f in self.cache.values():
+            h5f.close()
+        self.cache.clear()
+
+    def __getstate__(self):
+        """open handles can not be sent to other processes"""
+        state = self.__dict__.copy()
+        state['cache'] = OrderedDict()
+        return state
+
+    @staticmethod
+    def _get_group(h5f):
+        """group that holds the channel datasets"""
+        return h5f
 
     def get_channel_from_file(self, file, channel):
-        self.load(file, channel.name)
-        return self.cache[channel.name]
+        return self._get_group(self.load(file, str(channel)))[str(channel)]
 
-    def get_available_channels(self, file=None):
+    def get_available_channels(self, file=None, exclude=True):
         file = file if file is not None else self.files[0]
-        self.load(file)
+        channels = self.get_channels(file)
 
-        if self.exclude_patterns:
-            return [c for c in self.cache.keys() if not any(fnmatch(c, p) for p in self.exclude_patterns)]
+        if exclude and self.exclude_patterns:
+            return [c for c in channels if not any(fnmatch(c, p) for p in self.exclude_patterns)]
         else:
-            return list(self.cache.keys())
+            return list(channels)
+
+    def get_segment_channels(self, segment):
+        return self.get_available_channels(file=self.plan_reads(segment)[0][0], exclude=False)
+
+    def plan_reads(self, request_segment):
+        """
+        plans the reads of request_segment, so that every file is visited once and in order. The plan is cached,
+        since it is the same for every channel.
+
+        :return: list of (file, file segment, overlap with request_segment)
+        """
+        if request_segment not in self.plans:
+            request_segments = segments.segmentlist([request_segment]) & self.segments
+            self.plans[request_segment] = [
+                (self.files[i_segment], self.segments[i_segment], seg)
+                for seg in request_segments for i_segment in [self.segments.find(seg)]
+            ]
+        return self.plans[request_segment]
 
     def get_data_from_segments(self, request_segment, channel):
-        request_segments = segments.segmentlist([request_segment]) & self.segments
+        try:
+            all_data = [read(0, n_samples) for _, _, n_samples, read in self._iter_sources(request_segment, channel)]
+        except KeyError:
+            return None
 
-        all_data = []
-        for seg in request_segments:
-            i_segment = self.segments.find(seg)
-            h5_file = self.files[i_segment]
-            try:
-                channel_data = self.get_channel_from_file(h5_file, channel)
-            except KeyError:
-                return None
-            all_data.append(channel_data)
+        return all_data[0] if len(all_data) == 1 else np.concatenate(all_data)
+
+    def _iter_sources(self, request_segment, channel):
+        for h5_file, file_segment, seg in self.plan_reads(request_segment):
+            n_file = self.get_shape(h5_file, str(channel))[0]
+            f_sample = n_file / abs(file_segment)
+            i_start = int(round((seg[0] - file_segment[0]) * f_sample))
+            i_stop = int(round((seg[1] - file_segment[0]) * f_sample))
+
+            def read(i, j, h5_file=h5_file, i_start=i_start):
+                return self.get_channel_from_file(h5_file, channel)[i_start + i:i_start + j]
+
+            yield seg[0], f_sample, i_stop - i_start, read
+
+
+class ConsolidatedH5Reader(H5Reader):
+    """
+    Reader for the channel-major layout written by the Resampler, in which a file holds one long dataset per channel
+    over its whole GPS range. Any contiguous span of a channel is read as a single hyperslab.
+    """
 
-        return np.concatenate(all_data)
+    H5_DIR = 'ds_data/consolidated/'
+    CHANNELS = 'channels'
+    SEGMENTS = 'segments'
+
+    def _get_segments(self):
+        """
+        the segments that were written to the files, rather than the files themselves. Where files overlap, a segment
+        is taken from the most recently written file only, so that every span is read once. Older files only keep the
+        parts of their segments that no newer file holds.
+        """
+        self.file_spans, self.file_segments = {}, {}
+        claimed = segments.segmentlist()
+        for file in sorted(self.files, key=lambda f: os.path.getmtime(self.load(f).filename), reverse=True):
+            h5f = self.load(file)
+            self.file_spans[file] = segments.segment(h5f.attrs['gps_start'], h5f.attrs['gps_end'])
+            self.file_segments[file] = segments.segmentlist(
+                part for gs, ge in h5f[self.SEGMENTS][()] if ge > self.gps_start and gs < self.gps_end
+                for part in segments.segmentlist([segments.segment(gs, ge)]) - claimed
+            )
+            claimed = (claimed | self.file_segments[file]).coalesce()
+        return segments.segmentlist(sorted(seg for file_segments in self.file_segments.values()
+                                           for seg in file_segments))
+
+    @classmethod
+    def _get_group(cls, h5f):
+        return h5f[cls.CHANNELS]
+
+    def get_segment_channels(self, segment):
+        return self.get_available_channels(file=self.plan_reads(segment)[0][0], exclude=False)
+
+    def plan_reads(self, request_segment):
+        """every contiguous part of request_segment in a file is read at once"""
+        if request_segment not in self.plans:
+            self.plans[request_segment] = sorted((
+                (file, self.file_spans[file], seg)
+                for file in self.files
+                for seg in (segments.segmentlist([request_segment]) & self.file_segments[file]).coalesce()
+            ), key=lambda plan: plan[2])
+        return self.plans[request_segment]
+
+
+class MemoryMappedH5Reader(ConsolidatedH5Reader):
+    """
+    Reader for the memory mapped layout written by the Resampler, in which the channel datasets are stored
+    uncompressed and contiguously. Each file is mapped once and channel data is returned as read-only views of the
+    map, so no data is copied and concurrent runs share the page cache.
+    """
+
+    def __init__(self, gps_start, gps_end, exclude_patterns=None):
+        super(MemoryMappedH5Reader, self).__init__(gps_start, gps_end, exclude_patterns)
+        self.maps = {}
+        self.views = {}
+
+    def get_channel_from_file(self, file, channel):
+        if (file, str(channel)) not in self.views:
+            dataset = super(MemoryMappedH5Reader, self).get_channel_from_file(file, channel)
+            offset = dataset.id.get_offset()
+            if offset is None:  # chunked or never written, can not be mapped
+                return dataset
+            if file not in self.maps:
+                self.maps[file] = np.memmap(dataset.file.filename, mode='r')
+            n_bytes = dataset.size * dataset.dtype.itemsize
+            self.views[file, str(channel)] = self.maps[file][offset:offset + n_bytes].view(dataset.dtype)
+        return self.views[file, str(channel)]
+
+    def __getstate__(self):
+        """maps would be pickled as copies of the data"""
+        state = super(MemoryMappedH5Reader, self).__getstate__()
+        state['maps'] = {}
+        state['views'] = {}
+        return state
@@ -5,15 +5,20 @@
 import math
 import multiprocessing as mp
 import os
+import queue
+import time
 import warnings
+from collections import defaultdict
 
 import h5py
 import numpy as np
 import scipy.signal as sig
 from tqdm import tqdm
-from virgotools.frame_lib import FrameFile, FrVect2array
+from virgotools.frame_lib import FrameFile
 
 from application.config import config_manager
+from application.handler.data.manifest import DecimationManifest
+from application.handler.data.reader.ffl import adc_to_array
 from application.model.ffl_cache import FFLCache
 from application.utils.tools import almost_int
 from resources.constants import RESOURCE_DIR
@@ -21,6 +26,32 @@ from resources.constants import RESOURCE_DIR
 LOG = config_manager.get_logger(__name__)
 
 
+class StageCounter:
+    """throughput counter of a pipeline stage, counters of parallel workers of a stage can be added together"""
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.n_items = 0
+        self.n_bytes = 0
+        self.busy = 0.
+
+    def add(self, n_bytes, busy):
+        self.n_items += 1
+        self.n_bytes += n_bytes
+        self.busy += busy
+
+    def __iadd__(self, other):
+        self.n_items += other.n_items
+        self.n_bytes += other.n_bytes
+        self.busy += other.busy
+        return self
+
+    def __repr__(self):
+        rate = self.n_bytes / self.busy / 1e6 if self.busy else 0
+        return (f'{self.stage}: {self.n_items} frames, {self.n_bytes / 1e6:.1f} MB, {self.busy:.1f} s busy '
+                f'({rate:.1f} MB/s)')
+
+
 class Resampler:
 
     FILE_TEMPLATE = 'excavator_f{f_target}_gs{t_start}_ge{t_stop}_{method}'
@@ -29,66 +60,309 @@ class Resampler:
     FRAME_DURATION = 10
     FRAMES_IN_FRAME_FILE = 10
 
-    def __init__(self, f_target, method='mean'):
+    SEGMENT_MAJOR = 'segment'
+    CHANNEL_MAJOR = 'channel'
+    MEMORY_MAPPED = 'mmap'
+    CHANNELS = 'channels'
+    SEGMENTS = 'segments'
+    GAPS = 'gaps'
+    QUEUE_SIZE = 4  # frames per downsampling worker
+    QUEUE_TIMEOUT = 60  # seconds between checks that the workers are still alive while waiting for a frame
+    TMP = '.tmp'
+
+    def __init__(self, f_target, method='mean', layout=SEGMENT_MAJOR, n_readers=None, n_workers=None, verify=False):
+        """
+        :param layout: 'segment' stores a file per segment with a dataset per channel, 'channel' stores a single file
+        with one long dataset per channel over the whole GPS range, 'mmap' does the same with uncompressed contiguous
+        datasets that can be memory mapped
+        :param n_readers: number of frame reading processes, a quarter of the cores by default
+        :param n_workers: number of downsampling processes, the remaining cores by default
+        :param verify: verify the checksums of files that were downsampled before, instead of only their sizes
+        """
         self.f_target = f_target
         self.n_target = f_target * self.FRAME_DURATION
         self.method = method
+        self.layout = layout
         self.ds_path = RESOURCE_DIR + 'ds_data/'
         self.ds_data_path = self.ds_path + 'data/'
-        os.makedirs(self.ds_data_path, exist_ok=True)
-        LOG.info(f'Storing downsampled data at {self.ds_data_path}')
+        self.consolidated_path = self.ds_path + 'consolidated/'
+        data_path = self.ds_data_path if layout == self.SEGMENT_MAJOR else self.consolidated_path
+        os.makedirs(data_path, exist_ok=True)
+        LOG.info(f'Storing downsampled data at {data_path}')
+        self.manifest = DecimationManifest(data_path, verify=verify)
+        self.n_readers = n_readers
+        self.n_workers = n_workers
         self.source = None
         self.filt_cache = {}
 
     def downsample_ffl(self, ffl_cache: FFLCache):
+        """
+        Decimation runs as a pipeline of frame readers, downsampling workers and a single writer (this process), which
+        are connected by bounded queues. Reading, decompressing, filtering and writing thus overlap, and a full queue
+        makes the stage before it wait instead of piling up frames in memory.
+        """
         segments = [(gs, ge) for (gs, ge) in ffl_cache.segments]
         LOG.info(f'Downsampling data from {segments[0][0]} to {segments[-1][1]}')
         self.source = ffl_cache.ffl_file
 
-        n_cpu = min(mp.cpu_count() - 1, len(segments))
-        with mp.get_context('spawn').Pool(n_cpu) as pool:
-            for _ in tqdm(pool.imap_unordered(self.process_segment, segments), total=len(segments)):
-                pass
+        if self.layout == self.SEGMENT_MAJOR:
+            todo = [segment for segment in segments if not self._is_done(self._get_segment_file(segment), segment)]
+            LOG.info(f'Found {len(segments) - len(todo)} out of {len(segments)} segments already downsampled.')
+            segments = todo
+        elif self._is_done(self._get_consolidated_file(segments), (segments[0][0], segments[-1][1])):
+            segments = []
+        if not segments:
+            LOG.info('Nothing left to downsample.')
+            return
 
-    def process_segment(self, segment):
-        gps_start, gps_end = segment
+        frames = [(segment, t) for segment in segments for t in np.arange(*segment, self.FRAME_DURATION)]
+        n_cpu = max(mp.cpu_count() - 1, 2)
+        n_readers = self.n_readers or max(n_cpu // 4, 1)
+        n_workers = self.n_workers or max(n_cpu - n_readers, 1)
+
+        ctx = mp.get_context('spawn')
+        frame_queue = ctx.Queue()
+        raw_queue = ctx.Queue(maxsize=self.QUEUE_SIZE * n_workers)
+        ds_queue = ctx.Queue(maxsize=self.QUEUE_SIZE * n_workers)
+        stats_queue = ctx.Queue()
+        for frame in frames:
+            frame_queue.put(frame)
+        for _ in range(n_readers):
+            frame_queue.put(None)
+
+        processes = [ctx.Process(target=self._read_frames, args=(frame_queue, raw_queue, stats_queue))
+                     for _ in range(n_readers)]
+        processes += [ctx.Process(target=self._downsample_frames, args=(raw_queue, ds_queue, stats_queue))
+                      for _ in range(n_workers)]
+        for process in processes:
+            process.start()
+
+        writer_stats = StageCounter('writer')
+        try:
+            self._write_frames(ds_queue, n_frames=len(frames), segments=segments, stats=writer_stats,
+                               processes=processes)
+        except BaseException:
+            for process in processes:
+                process.terminate()
+            raise
+
+        for _ in range(n_workers):
+            raw_queue.put(None)
+        stats = {'reader': StageCounter('reader'), 'downsampler': StageCounter('downsampler')}
+        for _ in processes:
+            stage_stats = stats_queue.get()
+            stats[stage_stats.stage] += stage_stats
+        for process in processes:
+            process.join()
+
+        LOG.info(f'Decimated {len(frames)} frames with {n_readers} readers and {n_workers} downsampling workers.')
+        for stage_stats in (stats['reader'], stats['downsampler'], writer_stats):
+            LOG.info(stage_stats)
+
+    def _read_frames(self, frame_queue, raw_queue, stats_queue):
+        """reader stage: puts (segment, t, {f_sample: (channels, (channel, sample) data)}) on raw_queue, with the
+        channels grouped by sample rate, or None as data on failure"""
+        stats = StageCounter('reader')
+        for segment, t in iter(frame_queue.get, None):
+            t0 = time.perf_counter()
+            try:
+                groups = defaultdict(lambda: ([], []))
+                with FrameFile(self.source).get_frame(t) as ff:
+                    for adc in ff.iter_adc():
+                        f_sample = adc.contents.sampleRate
+                        if f_sample >= self.f_target:
+                            channels, data = groups[f_sample]
+                            channels.append(str(adc.contents.name))
+                            data.append(adc_to_array(adc))
+                raw_frame = {f_sample: (tuple(channels), np.stack(data))
+                             for f_sample, (channels, data) in groups.items()}
+            except Exception as e:
+                LOG.error(f'Unable to read frame at {t}: {e}')
+                raw_frame = None
+            stats.add(sum(data.nbytes for _, data in raw_frame.values()) if raw_frame else 0,
+                      time.perf_counter() - t0)
+            raw_queue.put((segment, t, raw_frame))
+        stats_queue.put(stats)
+
+    def _downsample_frames(self, raw_queue, ds_queue, stats_queue):
+        """downsampling stage: puts (segment, t, {channels: downsampled (channel, sample) data}) on ds_queue, every
+        group of channels that share a sample rate is downsampled at once"""
+        stats = StageCounter('downsampler')
+        for segment, t, raw_frame in iter(raw_queue.get, None):
+            t0 = time.perf_counter()
+            ds_frame = None
+            if raw_frame is not None:
+                ds_frame = {channels: self.downsample(data, f_sample)
+                            for f_sample, (channels, data) in raw_frame.items()}
+            stats.add(sum(data.nbytes for data in ds_frame.values()) if ds_frame else 0, time.perf_counter() - t0)
+            ds_queue.put((segment, t, ds_frame))
+        stats_queue.put(stats)
+
+    def _write_frames(self, ds_queue, n_frames, segments, stats, processes):
+        """
+        writer stage: writes frames as they come in, a file of the segment-major layout is closed as soon as all
+        frames of its segment are written. A segment of which a frame could not be read is not stored, so that it is
+        decimated again by the next run instead of holding a gap.
+
+        :param processes: reader and downsampling processes, the writer stops waiting for frames if any of them died
+        :raise RuntimeError: if a process died, or all processes ended, before all frames were written
+        """
+        frames_left = {segment: len(np.arange(*segment, self.FRAME_DURATION)) for segment in segments}
+        failed = set()
+        open_files = {}
+        consolidated = None
+        if self.layout in (self.CHANNEL_MAJOR, self.MEMORY_MAPPED):
+            consolidated = h5py.File(self._get_consolidated_file(segments) + self.TMP, 'w')
+            self._init_consolidated(consolidated, gps_start=segments[0][0], gps_end=segments[-1][1])
 
+        try:
+            for _ in tqdm(range(n_frames)):
+                segment, t, ds_frame = self._get_frame(ds_queue, processes)
+                t0 = time.perf_counter()
+                if ds_frame is None:
+                    failed.add(segment)
+                if consolidated is not None:
+                    if ds_frame is not None:
+                        self._write_consolidated(consolidated, t, ds_frame)
+                    if frames_left[segment] == 1 and segment not in failed:
+                        self._add_consolidated_segment(consolidated, segment)
+                else:
+                    if segment not in open_files:
+                        open_files[segment] = h5py.File(self._get_segment_file(segment) + self.TMP, 'w')
+                    if ds_frame is not None:
+                        self._write_segment(open_files[segment], segment, t, ds_frame)
+                    if frames_left[segment] == 1:
+                        open_files.pop(segment).close()
+                        if segment in failed:
+                            os.remove(self._get_segment_file(segment) + self.TMP)
+                        else:
+                            self._complete(self._get_segment_file(segment), segment)
+                frames_left[segment] -= 1
+                stats.add(sum(data.nbytes for data in ds_frame.values()) if ds_frame else 0, time.perf_counter() - t0)
+        finally:
+            for h5f in open_files.values():
+                h5f.close()
+            if consolidated is not None:
+                consolidated.close()
+        if failed:
+            LOG.error(f'Frames of {len(failed)} segments could not be read, these segments are not stored: '
+                      f'{sorted(failed)}')
+        if consolidated is not None:
+            file, span = self._get_consolidated_file(segments), (segments[0][0], segments[-1][1])
+            if failed:  # the segments that were read can be used, but the file is decimated again by the next run
+                os.replace(file + self.TMP, file)
+            else:
+                self._complete(file, span)
+                self._remove_superseded(file, span)
+
+    def _get_frame(self, ds_queue, processes):
+        """waits for the next downsampled frame, while checking that no process died without sending its frames"""
+        while True:
+            try:
+                return ds_queue.get(timeout=self.QUEUE_TIMEOUT)
+            except queue.Empty:
+                dead = [process for process in processes if process.exitcode not in (None, 0)]
+                if dead:
+                    raise RuntimeError(f'{len(dead)} resampling processes died, exit codes: '
+                                       f'{[process.exitcode for process in dead]}')
+                if not any(process.is_alive() for process in processes):
+                    raise RuntimeError('All resampling processes ended before all frames were written')
+                LOG.debug(f'No frame downsampled in {self.QUEUE_TIMEOUT} s, waiting...')
+
+    def _is_done(self, file, segment):
+        return self.manifest.is_valid(file, segment, method=self.method, f_target=self.f_target)
+
+    def _complete(self, file, segment):
+        """moves a completed file to its final name, so that an interrupted run never leaves a partial file behind,
+        and records it in the manifest"""
+        os.replace(file + self.TMP, file)
+        self.manifest.add(file, segment, method=self.method, f_target=self.f_target)
+
+    def _remove_superseded(self, file, segment):
+        """
+        removes the consolidated files of the same settings that lie within the range of file, which was rebuilt for
+        a changed or extended range. file is complete before, so readers always find the data in either file.
+        """
+        for entry in list(self.manifest.entries.values()):
+            old_file = self.consolidated_path + entry['file']
+            if old_file != file and entry['method'] == self.method and entry['f_target'] == self.f_target \
+                    and segment[0] <= entry['gps_start'] and entry['gps_end'] <= segment[1]:
+                LOG.info(f'Removing {old_file}, which is superseded by {file}')
+                if os.path.isfile(old_file):
+                    os.remove(old_file)
+                self.manifest.remove(old_file)
+
+    def _get_segment_file(self, segment):
+        gps_start, gps_end = segment
         file_name = self.FILE_TEMPLATE.format(f_target=self.f_target,
                                               t_start=int(gps_start),
                                               t_stop=int(gps_end),
                                               method=self.method)
-        file_path = self.ds_data_path + file_name
-
-        with h5py.File(file_path + '.h5', 'w') as h5f:
-            for t in np.arange(gps_start, gps_end, self.FRAME_DURATION):
-                self._store_data(h5_file=h5f, t=t, gps_start=gps_start)
-
-    def _store_data(self, h5_file, t, gps_start):
-        with FrameFile(self.source).get_frame(t) as ff:
-            for adc in ff.iter_adc():
-                f_sample = adc.contents.sampleRate
-                if f_sample >= self.f_target:
-                    channel = str(adc.contents.name)
-                    ds_adc = self.downsample_adc(adc, f_sample)
-                    if t == gps_start:
-                        ds_data = np.zeros(self.n_target * self.FRAMES_IN_FRAME_FILE)
-                        ds_data[0:self.n_target] = ds_adc
-                        h5_file.create_dataset(name=channel, data=ds_data)
-                    else:
-                        i = int((t - gps_start) * self.f_target)
-                        j = i + self.n_target
-                        h5_file[channel][i:j] = ds_adc
+        return self.ds_data_path + file_name + '.h5'
+
+    def _write_segment(self, h5_file, segment, t, ds_frame):
+        i = int((t - segment[0]) * self.f_target)
+        j = i + self.n_target
+        for channels, ds_group in ds_frame.items():
+            for channel, ds_adc in zip(channels, ds_group):
+                if channel not in h5_file:  # samples of frames without the channel stay NaN
+                    h5_file.create_dataset(name=channel, shape=(self.n_target * self.FRAMES_IN_FRAME_FILE,),
+                                           dtype=np.float64, fillvalue=np.nan)
+                h5_file[channel][i:j] = ds_adc
+
+    def _get_consolidated_file(self, segments):
+        file_name = self.FILE_TEMPLATE.format(f_target=self.f_target,
+                                              t_start=int(segments[0][0]),
+                                              t_stop=int(segments[-1][1]),
+                                              method=self.method)
+        return self.consolidated_path + file_name + '.h5'
+
+    def _init_consolidated(self, h5f, gps_start, gps_end):
+        """
+        Channel-major layout: one dataset per channel over the whole GPS range, in which sample i is at
+        gps_start + i / f_sample. Samples that are not covered by any segment are NaN and marked in the gap mask, the
+        segments that are covered are listed separately.
+        """
+        n_samples = int(round((gps_end - gps_start) * self.f_target))
+        h5f.attrs['gps_start'] = gps_start
+        h5f.attrs['gps_end'] = gps_end
+        h5f.attrs['f_sample'] = self.f_target
+        h5f.attrs['method'] = self.method
+        h5f.create_group(self.CHANNELS)
+        h5f.create_dataset(self.SEGMENTS, shape=(0, 2), maxshape=(None, 2), dtype=np.float64)
+        h5f.create_dataset(self.GAPS, shape=(n_samples,), dtype=bool, chunks=(self._chunk_size(n_samples),),
+                           fillvalue=True)
+
+    def _write_consolidated(self, h5f, t, ds_frame):
+        n_samples = h5f[self.GAPS].shape[0]
+        i = int(round((t - h5f.attrs['gps_start']) * self.f_target))
+        j = i + self.n_target
+
+        group = h5f[self.CHANNELS]
+        for channels, ds_group in ds_frame.items():
+            for channel, data in zip(channels, ds_group):
+                if channel not in group:
+                    chunks = None if self.layout == self.MEMORY_MAPPED else (self._chunk_size(n_samples),)
+                    group.create_dataset(channel, shape=(n_samples,), dtype=np.float64, chunks=chunks,
+                                         fillvalue=np.nan)
+                group[channel][i:j] = data
+        h5f[self.GAPS][i:j] = False
+
+    def _add_consolidated_segment(self, h5f, segment):
+        segments = h5f[self.SEGMENTS]
+        segments.resize(segments.shape[0] + 1, axis=0)
+        segments[-1] = segment
+
+    def _chunk_size(self, n_samples):
+        """one chunk per segment, so that every chunk is written once"""
+        return min(self.n_target * self.FRAMES_IN_FRAME_FILE, n_samples)
 
     def downsample_adc(self, adc, f_sample):
-        data = FrVect2array(adc.contents.data)
-        slope = adc.contents.slope
-        bias = adc.contents.bias
-        if slope != 1:
-            data = data.astype(np.float64, copy=False)
-            data *= slope
-        if bias != 0:
-            data += bias
+        return self.downsample(adc_to_array(adc), f_sample)
 
+    def downsample(self, data, f_sample):
+        """downsamples data along its last axis, so that a (channel, sample) stack of channels that share a sample
+        rate is downsampled in one go"""
         ds_data = None
 
         if self.method == 'mean':
@@ -103,7 +377,7 @@ class Resampler:
         return ds_data
 
     def _resample_mean(self, data):
-        n_points = data.size
+        n_points = data.shape[-1]
         ds_ratio = n_points / self.n_target
         if math.isclose(ds_ratio, 1):  # f_sample ~= f_target
             return data
@@ -111,7 +385,7 @@ class Resampler:
         if not almost_int(ds_ratio):
             n_padding = round(np.ceil(n_points / self.n_target) * self.n_target) - n_points
             data = self._add_padding(data, n_padding)
-            n_points = data.size
+            n_points = data.shape[-1]
             ds_ratio = n_points / self.n_target
 
         data = self._n_sample_average(data, ratio=round(ds_ratio))
@@ -131,22 +405,23 @@ class Resampler:
         step 4: flatten
         [1, 2, nan, 3, 4, nan, 5, 6, nan]
 
-        :param data: input data
+        :param data: input data, padded along the last axis
         :param n_padding: number of nans that will be padded to the data
         :return:
         """
-        try:
-            data = data.reshape(n_padding, round(data.size / n_padding))
-            nans = [[np.nan] for _ in range(n_padding)]
-            return np.hstack((data, nans)).flatten()
-        except ValueError:  # wasn't able to reshape
-            return np.append(data, [np.nan] * n_padding)
+        *shape, n_points = data.shape
+        if n_points % n_padding == 0:
+            data = data.reshape(*shape, n_padding, n_points // n_padding)
+            nans = np.full((*shape, n_padding, 1), np.nan)
+            return np.concatenate((data, nans), axis=-1).reshape(*shape, -1)
+        else:  # can't reshape
+            return np.concatenate((data, np.full((*shape, n_padding), np.nan)), axis=-1)
 
     @staticmethod
     def _n_sample_average(x: np.array, ratio: int):
         with warnings.catch_warnings():
             warnings.simplefilter("ignore", category=RuntimeWarning)
-            return np.nanmean(x.reshape(-1, ratio), axis=1)
+            return np.nanmean(x.reshape(*x.shape[:-1], -1, ratio), axis=-1)
 
     def _decimate(self, data, f_sample, filtfilt=False):
         ds_ratio = f_sample / self.f_target
@@ -160,9 +435,9 @@ class Resampler:
                 if ds_ratio not in self.filt_cache:
                     self.filt_cache[ds_ratio] = sig.cheby1(N=self.FILTER_ORDER, rp=0.05, Wn=0.8 / ds_ratio, output='sos')
                 if filtfilt:
-                    data = sig.sosfiltfilt(self.filt_cache[ds_ratio], data)[::int(ds_ratio)]
+                    data = sig.sosfiltfilt(self.filt_cache[ds_ratio], data, axis=-1)[..., ::int(ds_ratio)]
                 else:
-                    data = sig.sosfilt(self.filt_cache[ds_ratio], data)[::int(ds_ratio)]
+                    data = sig.sosfilt(self.filt_cache[ds_ratio], data, axis=-1)[..., ::int(ds_ratio)]
             return data
         else:
             return self._resample(data)
@@ -179,4 +454,4 @@ class Resampler:
             return [ds_ratio]
 
     def _resample(self, data):  # Fourier resampling
-        return sig.resample(data, self.n_target, window='hamming')
+        return sig.resample(data, self.n_target, window='hamming', axis=-1)
@@ -1,13 +1,18 @@
 """
     Trigger pipeline for locally stored triggers in the format as provided by GravitySpy (i.e. with the 'label'
-    attribute)
+    attribute). The CSV file is converted once into a binary columnar cache, in which the labels are stored as integer
+    codes and the GPS times are sorted per label, so that triggers are selected with searchsorted only.
 """
 
+import os
+
+import h5py
 import numpy as np
 
 from .trigger_pipeline import TriggerPipeline
 from application.handler.data.reader.csv import CSVReader
 from application.config import config_manager
+from resources.constants import RESOURCE_DIR
 
 LOG = config_manager.get_logger(__name__)
 
@@ -17,25 +22,70 @@ class LocalPipeline(TriggerPipeline):
     NAME = 'local'
     GPS_TIME = 'GPStime'
     LABEL = 'label'
+    CACHE_DIR = 'triggers/local/'
 
     def __init__(self, trigger_file, trigger_type=None):
         super(LocalPipeline, self).__init__()
         self.reader = CSVReader()
         self.trigger_type = trigger_type
-        self.triggers = self._load_triggers(trigger_file)
+        self.gps, self.indptr, self.labels = self._load_triggers(trigger_file)
 
     def _load_triggers(self, path_to_csv):
-        triggers = self.reader.load_csv(path_to_csv, usecols=[self.GPS_TIME, self.LABEL])
-        if self.trigger_type:
-            triggers = triggers.loc[triggers[self.LABEL] == self.trigger_type]
-            self.labels = [self.trigger_type]
-        else:
-            self.labels = set(triggers[self.LABEL].values)
-        sorted_triggers = triggers.sort_values(self.GPS_TIME)
-        return sorted_triggers
+        """
+        :return: GPS times sorted by label and then by time, the offset of every label in these GPS times and the
+            labels in the order of their codes
+        """
+        csv_file = self.reader.locate(path_to_csv)
+        cache_file = RESOURCE_DIR + self.CACHE_DIR + os.path.splitext(os.path.basename(csv_file))[0] + '.h5'
+        stat = os.stat(csv_file)
+        if not self._is_cached(cache_file, stat):
+            self._convert(csv_file, cache_file, stat)
+
+        with h5py.File(cache_file, 'r') as h5f:
+            labels = list(h5f['labels'].asstr()[()])
+            indptr = h5f['indptr'][()]
+            if self.trigger_type:
+                gps = np.zeros(0)
+                if self.trigger_type in labels:
+                    code = labels.index(self.trigger_type)
+                    gps = h5f['gps'][indptr[code]:indptr[code + 1]]
+                return gps, np.array([0, gps.size]), [self.trigger_type]
+            return h5f['gps'][()], indptr, labels
+
+    @staticmethod
+    def _is_cached(cache_file, stat):
+        if not os.path.isfile(cache_file):
+            return False
+        with h5py.File(cache_file, 'r') as h5f:
+            return h5f.attrs['csv_size'] == stat.st_size and h5f.attrs['csv_mtime'] == stat.st_mtime
+
+    def _convert(self, csv_file, cache_file, stat):
+        """the cache is written under a temporary name first, so that a crash never corrupts it"""
+        LOG.info(f'Converting triggers in {csv_file} to {cache_file}')
+        triggers = self.reader.load_csv(csv_file, usecols=[self.GPS_TIME, self.LABEL])
+        labels, codes = np.unique(triggers[self.LABEL].values.astype(str), return_inverse=True)
+        gps = triggers[self.GPS_TIME].values.astype(float)
+        order = np.lexsort((gps, codes))
+        indptr = np.concatenate(([0], np.cumsum(np.bincount(codes, minlength=labels.size))))
+
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmp_file = cache_file + '.tmp'
+        with h5py.File(tmp_file, 'w') as h5f:
+            h5f.attrs['csv_size'] = stat.st_size
+            h5f.attrs['csv_mtime'] = stat.st_mtime
+            h5f.create_dataset('labels', data=labels.tolist(), dtype=h5py.string_dtype())
+            h5f.create_dataset('indptr', data=indptr)
+            h5f.create_dataset('gps', data=gps[order])
+        os.replace(tmp_file, cache_file)
+
+    def get_labelled_segment(self, gps_start, gps_end):
+        triggers = {}
+        for label, i, j in zip(self.labels, self.indptr[:-1], self.indptr[1:]):
+            label_gps = self.gps[i:j]
+            triggers[label] = label_gps[slice(*np.searchsorted(label_gps, (gps_start, gps_end)))]
+        LOG.info(f'Found {sum(t.size for t in triggers.values())} triggers of type '
+                 f'{self.trigger_type if self.trigger_type else "[all]"} from {gps_start} to {gps_end}.')
+        return triggers
 
     def get_segment(self, gps_start, gps_end):
-        i_start, i_end = np.searchsorted(self.triggers[self.GPS_TIME], (gps_start, gps_end))
-        LOG.info(f'Found {i_end - i_start} triggers of type {self.trigger_type if self.trigger_type else "[all]"} '
-                 f'from {gps_start} to {gps_end}.')
-        return self.triggers[i_start:i_end]
+        return np.sort(np.concatenate(list(self.get_labelled_segment(gps_start, gps_end).values())))
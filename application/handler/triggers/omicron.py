@@ -1,14 +1,20 @@
 """
     Trigger pipeline for Omicron triggers. Loads all triggers in a segment with an SNR > snr_threshold.
+    Retrieved triggers are kept in an on-disk cache per channel, only intervals that are not cached yet are fetched
+    from omicron-print, split into sub-intervals that are fetched concurrently.
 """
 
-from subprocess import Popen, PIPE
+import io
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import run, PIPE, CalledProcessError
 
 import numpy as np
 
 from application.config import config_manager
 from application.utils import exit_on_error
+from .trigger_cache import TriggerCache
 from .trigger_pipeline import TriggerPipeline
+from resources.constants import RESOURCE_DIR
 
 LOG = config_manager.get_logger(__name__)
 
@@ -16,32 +22,63 @@ LOG = config_manager.get_logger(__name__)
 class Omicron(TriggerPipeline):
 
     NAME = 'omicron'
-    COMMAND = 'omicron-print channel={0} gps-start={1:d} gps-end={2:d}'
-    FORMAT = [('gps', float), ('freq', float), ('snr', float)]
+    EXECUTABLE = 'omicron-print'
+    ARGUMENTS = ['channel={0}', 'gps-start={1:d}', 'gps-end={2:d}']
+    FORMAT = TriggerCache.FORMAT
+    CACHE_DIR = 'triggers/omicron/'
+    FETCH_DURATION = 86400  # maximum duration of a single omicron-print call
+    N_FETCH = 4
 
-    def __init__(self, channel, snr_threshold=None):
+    def __init__(self, channel, snr_threshold=None, executable=EXECUTABLE, n_fetch=N_FETCH):
+        """
+        :param executable: omicron-print, or a stand-in with the same interface
+        :param n_fetch: number of omicron-print calls that run concurrently
+        """
         super(Omicron, self).__init__()
         self.channel = channel
         self.snr_threshold = snr_threshold
+        self.executable = executable
+        self.n_fetch = n_fetch
         self.labels = {self.NAME}
+        self.cache = TriggerCache(file=RESOURCE_DIR + self.CACHE_DIR + f'{self.channel}.h5')
 
     def get_segment(self, gps_start, gps_end):
-        LOG.info(f"Loading Omicron triggers from {gps_start} to {gps_end}...")
-        command = self.COMMAND.format(self.channel, gps_start, gps_end)
-        process = Popen(command, stdout=PIPE, shell=True)
-        data = process.stdout
-        if data.readline():
-            triggers = np.loadtxt(data, dtype=self.FORMAT)
-            triggers = triggers.view(dtype=(np.record, triggers.dtype), type=np.recarray)
-            if self.snr_threshold:
-                triggers = triggers[triggers.snr > self.snr_threshold]
-            triggers.sort(order='gps')
-            LOG.info(f'Found {triggers.shape[0]} triggers.')
-            return triggers.gps
+        gaps = self.cache.get_gaps(gps_start, gps_end)
+        if gaps:
+            intervals = [(int(t), int(min(t + self.FETCH_DURATION, end)))
+                         for start, end in gaps for t in np.arange(start, end, self.FETCH_DURATION)]
+            LOG.info(f"Loading Omicron triggers from {gps_start} to {gps_end} in {len(intervals)} intervals...")
+            with ThreadPoolExecutor(max_workers=min(self.n_fetch, len(intervals))) as executor:
+                fetched = list(executor.map(lambda interval: self._fetch(*interval), intervals))
+            for interval, triggers in zip(intervals, fetched):
+                if triggers is None:
+                    LOG.error(f"Failed to load triggers between {interval[0]} and {interval[1]}. Are you in the "
+                              f"correct environment? Try 'source /virgoDev/Omicron/vXrYpZ/cmt/setup.sh' first.")
+                    exit_on_error()
+                self.cache.add(*interval, triggers)
+            self.cache.save()
         else:
-            LOG.error(f"No triggers found / failed to load triggers between {gps_start} and {gps_end}. "
-                      f"Are you in the correct environment? Try 'source /virgoDev/Omicron/vXrYpZ/cmt/setup.sh' first.")
-            exit_on_error()
+            LOG.info(f"Loading cached Omicron triggers from {gps_start} to {gps_end}...")
+
+        triggers = self.cache.get(gps_start, gps_end, snr_threshold=self.snr_threshold)
+        LOG.info(f'Found {triggers.shape[0]} triggers.')
+        return triggers['gps']
+
+    def _fetch(self, gps_start, gps_end):
+        """
+        :return: the triggers printed by omicron-print, which are none if it only printed a header or nothing at all
+            for an interval without triggers, or None if it could not be run or exited with an error
+        """
+        command = [self.executable] + [a.format(self.channel, gps_start, gps_end) for a in self.ARGUMENTS]
+        try:
+            process = run(command, stdout=PIPE, check=True)
+        except (OSError, CalledProcessError) as e:
+            LOG.debug(f'{" ".join(command)} failed: {e}')
+            return None
+        _, _, rows = process.stdout.partition(b'\n')  # the first line is a header
+        if not rows.strip():
+            return np.zeros(0, dtype=self.FORMAT)
+        return np.loadtxt(io.BytesIO(rows), dtype=self.FORMAT, ndmin=1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,86 @@
+"""
+    On-disk cache of the triggers of a single channel. Triggers are stored as binary columns (gps, freq, snr) sorted by
+    GPS time, together with the GPS intervals that were already retrieved, so that a query only has to fetch the gaps.
+"""
+
+import os
+
+import h5py
+import numpy as np
+
+from application.config import config_manager
+
+LOG = config_manager.get_logger(__name__)
+
+
+class TriggerCache:
+
+    FORMAT = [('gps', float), ('freq', float), ('snr', float)]
+
+    def __init__(self, file):
+        self.file = file
+        self.triggers = np.zeros(0, dtype=self.FORMAT)
+        self.intervals = np.zeros((0, 2), dtype=float)
+        if os.path.isfile(self.file):
+            self._load()
+            LOG.info(f'Loaded {self.triggers.size} cached triggers in {len(self.intervals)} intervals from {self.file}')
+
+    def _load(self):
+        with h5py.File(self.file, 'r') as h5f:
+            self.intervals = h5f['intervals'][()].reshape(-1, 2)
+            self.triggers = np.zeros(h5f['gps'].shape[0], dtype=self.FORMAT)
+            for name, _ in self.FORMAT:
+                self.triggers[name] = h5f[name][()]
+
+    def save(self):
+        """the cache is written under a temporary name first, so that a crash never corrupts it"""
+        os.makedirs(os.path.dirname(self.file), exist_ok=True)
+        tmp_file = self.file + '.tmp'
+        with h5py.File(tmp_file, 'w') as h5f:
+            h5f.create_dataset('intervals', data=self.intervals)
+            for name, _ in self.FORMAT:
+                h5f.create_dataset(name, data=self.triggers[name])
+        os.replace(tmp_file, self.file)
+
+    def get_gaps(self, gps_start, gps_end):
+        """:return: list of (gps_start, gps_end) within the requested range that are not cached yet"""
+        gaps = []
+        t = gps_start
+        for start, end in self.intervals:
+            if end <= t:
+                continue
+            if start >= gps_end:
+                break
+            if start > t:
+                gaps.append((t, start))
+            t = max(t, end)
+        if t < gps_end:
+            gaps.append((t, gps_end))
+        return gaps
+
+    def add(self, gps_start, gps_end, triggers):
+        """
+        adds the triggers retrieved for an interval. Triggers outside of the interval are dropped, so that adjacent
+        intervals never hold the same trigger twice.
+        """
+        triggers = triggers[(triggers['gps'] >= gps_start) & (triggers['gps'] < gps_end)]
+        self.triggers = np.concatenate((self.triggers, triggers.astype(self.FORMAT)))
+        self.triggers.sort(order='gps', kind='stable')
+
+        intervals = np.concatenate((self.intervals, [[gps_start, gps_end]]))
+        intervals = intervals[np.argsort(intervals[:, 0], kind='stable')]
+        merged = [list(intervals[0])]
+        for start, end in intervals[1:]:
+            if start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        self.intervals = np.array(merged, dtype=float)
+
+    def get(self, gps_start, gps_end, snr_threshold=None):
+        """:return: the cached triggers from gps_start to gps_end, sorted by GPS time"""
+        i_start, i_end = np.searchsorted(self.triggers['gps'], (gps_start, gps_end))
+        triggers = self.triggers[i_start:i_end]
+        if snr_threshold:
+            triggers = triggers[triggers['snr'] > snr_threshold]
+        return triggers
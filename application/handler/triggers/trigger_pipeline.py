@@ -14,3 +14,8 @@ class TriggerPipeline:
 
     def get_segment(self, gps_start, gps_end):
         pass
+
+    def get_labelled_segment(self, gps_start, gps_end):
+        """:return: {label: sorted GPS times of the triggers with that label}"""
+        triggers = self.get_segment(gps_start, gps_end)
+        return {label: triggers for label in self.labels}
@@ -2,6 +2,10 @@
     Container classes for channel data read from FFL/.h5 files.
 """
 
+from collections import namedtuple
+
+DataBlock = namedtuple('DataBlock', ['data', 'gps_start', 'contiguous'])
+
 
 class Channel:
 
@@ -13,6 +17,13 @@ class Channel:
     def __repr__(self):
         return self.name
 
+    def __eq__(self, other):
+        """channels are identified by their name, so that copies sent to other processes match the original"""
+        return isinstance(other, Channel) and self.name == other.name
+
+    def __hash__(self):
+        return hash(self.name)
+
     def __iter__(self):
         for value in vars(self).values():
             yield value
@@ -2,7 +2,6 @@
     Anderson-Darling test implementation.
 """
 
-import copy as cp
 from collections import namedtuple
 
 import numpy as np
@@ -16,6 +15,7 @@ ADResult = namedtuple('ADResult', ['ad', 'below_critical'])
 
 class AndersonDarling:
     CRITICAL_VALUES = {0.01: 3.857, 0.05: 2.492, 0.10: 1.933}
+    BATCH_SIZE = 1024
 
     def __init__(self, alpha=0.05):
         super(AndersonDarling, self).__init__()
@@ -24,22 +24,43 @@ class AndersonDarling:
 
     def calculate(self, channel, transformation, h_aux, h_trig):
         if h_aux.const_val is None:
-            d_n = self._get_distances(h_aux=h_aux, h_trig=h_trig)
-            combined = self._combine_hist(h_aux, h_trig)
-            combined_ecdf = combined.cdf * (1 - combined.cdf)
-            ad = np.sum(np.divide(d_n, np.sqrt(combined_ecdf), out=np.zeros_like(d_n), where=combined_ecdf != 0))
-            ad /= np.sqrt(combined.ntot)
+            ad = self._get_statistics(h_aux.counts[None], h_trig.counts[None])[0]
             result = ADResult(ad, ad < self.critical_value)
             self.scores[channel, transformation] = result
             return result
 
-    @staticmethod
-    def _get_distances(h_aux, h_trig):
-        return np.abs(h_aux.cdf - h_trig.cdf)
+    def calculate_batch(self, keys, counts_aux, counts_trig):
+        """
+        Scores a stack of histograms at once.
+
+        :param keys: (channel, transformation) for each row
+        :param counts_aux: (n, nbin) counts of the auxiliary histograms
+        :param counts_trig: (n, nbin) counts of the trigger histograms, aligned row by row with counts_aux
+        :return: array of the AD statistic for every row
+        """
+        ad = np.empty(len(keys))
+        for i in range(0, len(keys), self.BATCH_SIZE):
+            j = i + self.BATCH_SIZE
+            ad[i:j] = self._get_statistics(counts_aux[i:j], counts_trig[i:j])
+
+        for key, statistic in zip(keys, ad):
+            self.scores[tuple(key)] = ADResult(statistic, statistic < self.critical_value)
+        return ad
 
     @staticmethod
-    def _combine_hist(h1, h2):
-        h1_cp = cp.deepcopy(h1)
-        h2_cp = cp.deepcopy(h2)
-        h1_cp += h2_cp
-        return h1_cp
+    def _get_statistics(counts_aux, counts_trig):
+        """AD statistic of aligned (n, nbin) counts, weighted with the cdf of the pooled sample"""
+        n_aux = counts_aux.sum(axis=1, dtype=np.int64)[:, None]
+        n_trig = counts_trig.sum(axis=1, dtype=np.int64)[:, None]
+        cdf_aux = counts_aux.cumsum(axis=1, dtype=np.int64)
+        cdf_trig = counts_trig.cumsum(axis=1, dtype=np.int64)
+
+        weight = (cdf_aux + cdf_trig) / (n_aux + n_trig)
+        weight *= 1 - weight
+        np.sqrt(weight, out=weight)
+
+        d_n = cdf_aux / n_aux
+        d_n -= cdf_trig / n_trig
+        np.abs(d_n, out=d_n)
+        ad = np.sum(np.divide(d_n, weight, out=np.zeros_like(d_n), where=weight != 0), axis=1)
+        return ad / np.sqrt(n_aux[:, 0] + n_trig[:, 0])
@@ -2,6 +2,7 @@
     Kolmogorov-Smirnov test implementation. Includes bootstrapping.
 """
 
+import multiprocessing as mp
 from collections import namedtuple
 
 import numpy as np
@@ -18,9 +19,18 @@ KSResult = namedtuple('KSResult', ['d_n', 'std_d_n', 'p', 'std_p'])
 
 class KolmogorovSmirnov:
 
-    def __init__(self):
+    BATCH_SIZE = 1024
+    P_TABLE_SIZE = 257
+    P_TABLE_MIN = 1e-20  # smallest p value in the interpolation table
+    P_TABLE_MIN_COUNT = 1024
+    BOOTSTRAP_FRACTION = 5
+    BOOTSTRAP_BATCH_SIZE = 500
+
+    def __init__(self, seed=None):
+        """:param seed: seed of the bootstrap, or a SeedSequence, e.g. a child of the seed of the run"""
         super(KolmogorovSmirnov, self).__init__()
         self.scores = {}
+        self.seed_sequence = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
 
     def calculate(self, channel, transformation, h_aux, h_trig, bootstrap=False):
         if h_aux.const_val is None:
@@ -32,6 +42,57 @@ class KolmogorovSmirnov:
                 p = self._get_p_value(d_n, h_aux.ntot, h_trig.ntot)
                 self.scores[channel, transformation] = KSResult(d_n, None, p, None)
 
+    def calculate_batch(self, keys, counts_aux, counts_trig):
+        """
+        Scores a stack of histograms at once.
+
+        :param keys: (channel, transformation) for each row
+        :param counts_aux: (n, nbin) counts of the auxiliary histograms
+        :param counts_trig: (n, nbin) counts of the trigger histograms, aligned row by row with counts_aux
+        :return: arrays of d_n and p for every row
+        """
+        n_aux = counts_aux.sum(axis=1)
+        n_trig = counts_trig.sum(axis=1)
+        d_n = np.empty(len(keys))
+        for i in range(0, len(keys), self.BATCH_SIZE):
+            j = i + self.BATCH_SIZE
+            cdf_aux = counts_aux[i:j].cumsum(axis=1, dtype=float)
+            cdf_aux /= n_aux[i:j, None]
+            cdf_trig = counts_trig[i:j].cumsum(axis=1, dtype=float)
+            cdf_trig /= n_trig[i:j, None]
+            cdf_aux -= cdf_trig
+            d_n[i:j] = np.amax(np.abs(cdf_aux, out=cdf_aux), axis=1)
+        p = self._get_p_values(d_n, n_aux, n_trig)
+
+        for key, d, p_value in zip(keys, d_n, p):
+            self.scores[tuple(key)] = KSResult(d, None, p_value, None)
+        return d_n, p
+
+    @classmethod
+    def _get_p_values(cls, d_n, n1, n2):
+        """
+        Vectorized version of _get_p_value. Effective sample sizes that occur often, e.g. when all channels are scored
+        against the same triggers, are evaluated once on a grid of distances and interpolated in log space. The grid
+        only covers the distances where the sf is above P_TABLE_MIN, which shrink as 1 / sqrt(n), so it stays dense
+        where the sf changes. Larger distances are evaluated exactly.
+        """
+        n = np.round(n1 * n2 / (n1 + n2)).astype(np.int64)
+        p = np.empty(d_n.size)
+        n_unique, inverse, n_counts = np.unique(n, return_inverse=True, return_counts=True)
+        direct = n_counts[inverse.ravel()] < cls.P_TABLE_MIN_COUNT
+        for n_eff in n_unique[n_counts >= cls.P_TABLE_MIN_COUNT]:
+            mask = n == n_eff
+            # sf(d) < 2 exp(-2 n d^2), so sf < P_TABLE_MIN beyond d_max
+            d_max = min(np.sqrt(np.log(2 / cls.P_TABLE_MIN) / (2 * n_eff)), 1)
+            outside = mask & (d_n > d_max)
+            direct |= outside
+            mask &= ~outside
+            grid = np.linspace(0, d_max, cls.P_TABLE_SIZE)
+            log_sf = np.log(np.maximum(kstwo.sf(grid, n_eff), np.finfo(float).tiny))
+            p[mask] = np.exp(np.interp(d_n[mask], grid, log_sf))
+        p[direct] = kstwo.sf(d_n[direct], n[direct])
+        return np.clip(p, 0, 1)
+
     @staticmethod
     def _get_distance(h_aux, h_trig):
         return np.amax(np.abs(h_aux.cdf - h_trig.cdf))
@@ -45,47 +106,69 @@ class KolmogorovSmirnov:
         return np.clip(kstwo.sf(d_n, round(n)), 0, 1)
 
     def bootstrap(self, h_aux, h_trig, n_cycles=5000):
-        np.set_printoptions(threshold=np.inf)
-
-        counts1, dx1 = h_aux.counts, (h_aux.x_max - h_aux.x_min) / h_aux.nbin
-        counts2, dx2 = h_trig.counts, (h_trig.x_max - h_trig.x_min) / h_trig.nbin
-
-        bin_edges1 = h_aux.x_min + dx1 * np.arange(h_aux.nbin)
-        bin_edges2 = h_trig.x_min + dx2 * np.arange(h_trig.nbin)
-
-        points1 = np.concatenate([
-            np.random.uniform(low=edge1, high=edge2, size=counts1[i])
-            for i, (edge1, edge2) in enumerate(zip(bin_edges1[0:-1], bin_edges1[1:]))
-        ])
-        points2 = np.concatenate([
-            np.random.uniform(low=edge1, high=edge2, size=counts2[i])
-            for i, (edge1, edge2) in enumerate(zip(bin_edges2[0:-1], bin_edges2[1:]))
-        ])
-
-        size1 = h_aux.ntot // 5
-        size2 = h_trig.ntot // 5
-        distances, probabilities = [], []
-        for _ in range(n_cycles):
-            sample1 = np.random.choice(points1, size=size1, replace=True)
-            sample2 = np.random.choice(points2, size=size2, replace=True)
-
-            hist1, _ = np.histogram(sample1, bins=bin_edges1)
-            hist2, _ = np.histogram(sample2, bins=bin_edges2)
-
-            cdf1 = hist1.cumsum() / size1
-            cdf2 = hist2.cumsum() / size2
-
-            d_n = np.amax(np.abs(cdf1 - cdf2))
-            p = self._get_p_value(d_n, size1, size2)
-
-            distances.append(d_n)
-            probabilities.append(p)
+        h_aux.align(h_trig)
+        return self._bootstrap_counts((h_aux.counts, h_trig.counts, n_cycles, self.seed_sequence.spawn(1)[0]))
+
+    def bootstrap_batch(self, keys, counts_aux, counts_trig, n_cycles=5000, n_processes=1):
+        """
+        Bootstraps a stack of histograms. Every row gets its own child seed, so the results do not depend on how the
+        rows are divided over the processes.
+
+        :param keys: (channel, transformation) for each row
+        :param counts_aux: (n, nbin) counts of the auxiliary histograms
+        :param counts_trig: (n, nbin) counts of the trigger histograms, aligned row by row with counts_aux
+        """
+        seeds = self.seed_sequence.spawn(len(keys))
+        tasks = [(counts_aux[i], counts_trig[i], n_cycles, seeds[i]) for i in range(len(keys))]
+        if n_processes > 1:
+            with mp.get_context('spawn').Pool(n_processes) as pool:
+                results = pool.map(self._bootstrap_counts, tasks, chunksize=max(1, len(tasks) // (4 * n_processes)))
+        else:
+            results = map(self._bootstrap_counts, tasks)
+
+        for key, result in zip(keys, results):
+            self.scores[tuple(key)] = KSResult(*result)
+
+    @classmethod
+    def _bootstrap_counts(cls, task):
+        """
+        Resamples the bin counts directly with multinomial draws, many replicas at once. Only the bins that are
+        filled in either histogram are drawn, since the cdfs are constant in between.
+        """
+        counts_aux, counts_trig, n_cycles, seed = task
+        rng = np.random.default_rng(seed)
+
+        filled = np.flatnonzero(counts_aux | counts_trig)
+        counts_aux, counts_trig = counts_aux[filled], counts_trig[filled]
+        n_aux, n_trig = counts_aux.sum(), counts_trig.sum()
+        size_aux = max(n_aux // cls.BOOTSTRAP_FRACTION, 1)
+        size_trig = max(n_trig // cls.BOOTSTRAP_FRACTION, 1)
+
+        distances = np.empty(n_cycles)
+        for i in range(0, n_cycles, cls.BOOTSTRAP_BATCH_SIZE):
+            n_batch = min(cls.BOOTSTRAP_BATCH_SIZE, n_cycles - i)
+            cdf_aux = cls._multinomial(rng, size_aux, counts_aux / n_aux, n_batch).cumsum(axis=1) / size_aux
+            cdf_trig = cls._multinomial(rng, size_trig, counts_trig / n_trig, n_batch).cumsum(axis=1) / size_trig
+            cdf_aux -= cdf_trig
+            distances[i:i + n_batch] = np.amax(np.abs(cdf_aux, out=cdf_aux), axis=1)
+        probabilities = cls._get_p_values(distances, np.full(n_cycles, size_aux), np.full(n_cycles, size_trig))
 
         return np.mean(distances), np.std(distances), np.mean(probabilities), np.std(probabilities)
 
+    @staticmethod
+    def _multinomial(rng, n, pvals, size):
+        """multinomial draws of shape (size, len(pvals)). Small samples are drawn by inverting the cdf instead, which
+        costs O(n) rather than O(len(pvals)) per draw."""
+        if n >= pvals.size:
+            return rng.multinomial(n, pvals, size=size)
+        ind = np.searchsorted(np.cumsum(pvals), rng.random((size, n)), side='right')
+        np.minimum(ind, pvals.size - 1, out=ind)
+        ind += np.arange(size)[:, None] * pvals.size
+        return np.bincount(ind.ravel(), minlength=size * pvals.size).reshape(size, pvals.size)
+
 
 if __name__ == '__main__':
-    fom = KolmogorovSmirnov()
+    fom = KolmogorovSmirnov(seed=1)
     n = 485672
     m = 1341
     x = np.random.normal(loc=0, scale=100, size=n)
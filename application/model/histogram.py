@@ -25,11 +25,17 @@ from application.config import config_manager
 LOG = config_manager.get_logger(__name__)
 
 flintmax = 2 ** 53
+NO_SPAN = np.iinfo(np.int64).min  # span of a HistBank row that is not expanded
 
 
-def myfloor(x, lg2):
-    """floor(x * 2**lg2), as integer"""
-    return np.floor(x * 2.0 ** lg2).astype(np.int64)
+def myfloor(x, lg2, out=None, tmp=None):
+    """floor(x * 2**lg2), as integer. If given, the result is written to the integer array out and the intermediate
+    floats to tmp."""
+    if out is None:
+        return np.floor(x * 2.0 ** lg2).astype(np.int64)
+    tmp = np.floor(np.multiply(x, 2.0 ** lg2, out=tmp), out=tmp)
+    np.copyto(out, tmp, casting='unsafe')
+    return out
 
 
 def myroll(x, shift):
@@ -118,6 +124,77 @@ class Hist:
 
         self.check()
 
+    @classmethod
+    def from_state(cls, l2_nbin, ntot, x_min=None, x_max=None, l2_span=None, i_offset=None, i_min=None, i_max=None,
+                   counts=None, compact=None):
+        """creates a histogram directly from its internal state, e.g. a single row of a HistBank. The counts can be
+        given either dense or in the compact form of Hist.compact"""
+        hist = cls.__new__(cls)
+        hist.l2_nbin = l2_nbin
+        hist.nbin = 2 ** l2_nbin
+        hist.ntot = int(ntot)
+        hist.const_val = None
+        if hist.isempty:
+            return hist
+
+        hist.x_min = x_min
+        hist.x_max = x_max
+        if x_min == x_max:
+            hist.const_val = x_min
+            return hist
+
+        hist.l2_span = int(l2_span)
+        hist.i_offset = int(i_offset)
+        hist.i_min = int(i_min)
+        hist.i_max = int(i_max)
+        if compact is not None:
+            hist._compact = compact
+        else:
+            hist.counts = counts
+        return hist
+
+    @property
+    def counts(self):
+        """dense counts, restored from the compact representation if needed"""
+        compact = self.__dict__.pop('_compact', None)
+        if compact is not None:
+            counts = np.zeros(self.nbin, dtype=np.uint32)
+            istart = self.i_min - self.i_offset
+            if len(compact) == 1:
+                window, = compact
+                counts[istart:istart + window.size] = window
+            else:
+                bins, values = compact
+                counts[istart + bins] = values
+            self._counts = counts
+        return self._counts
+
+    @counts.setter
+    def counts(self, counts):
+        self.__dict__.pop('_compact', None)
+        self._counts = counts
+
+    @property
+    def iscompact(self):
+        return '_compact' in self.__dict__
+
+    def compact(self):
+        """keeps only the occupied bins [i_min, i_max], or only the non-zero bins as (bin, count) pairs if most of
+        these are empty, so that memory scales with the number of points rather than the number of bins. The dense
+        counts are restored transparently when they are needed."""
+        if not self.isexpanded or self.iscompact:
+            return self
+
+        istart = self.i_min - self.i_offset
+        window = self.counts[istart:self.i_max - self.i_offset + 1]
+        bins = np.flatnonzero(window)
+        if 2 * bins.size < window.size:
+            self._compact = (bins.astype(np.uint32), window[bins])
+        else:
+            self._compact = (window.copy(),)
+        del self._counts
+        return self
+
     @property
     def isempty(self):
         return self.ntot == 0
@@ -163,39 +240,47 @@ class Hist:
         return 'histogram of %i points, span = %g, offset = %g' % (
             self.ntot, self.span, self.offset)
 
-    def enlarge(self):
-        """increase span by 2 and merge bins"""
+    def enlarge(self, levels=1):
+        """increase span by 2**levels and merge bins, in a single reshape-and-sum"""
         assert self.isexpanded
+        if levels == 0:
+            return
+
+        factor = 2 ** levels
+        head = min(-self.i_offset % factor, self.nbin)  # bins before the first boundary of a merged bin
+        n_body = (self.nbin - head) // factor * factor
 
         newcounts = np.zeros(self.nbin, dtype=np.uint32)
-        if self.i_offset % 2:
-            newcounts[0] = self.counts[0]
-            newcounts[1:self.nbin // 2] = (self.counts[1:-1:2] +
-                                           self.counts[2:-1:2])
-            newcounts[self.nbin // 2] = self.counts[-1]
-        else:
-            newcounts[:self.nbin // 2] = self.counts[::2] + self.counts[1::2]
+        i = 0
+        if head:
+            newcounts[0] = self.counts[:head].sum()
+            i = 1
+        body = self.counts[head:head + n_body].reshape(-1, factor).sum(axis=1, dtype=np.uint32)
+        newcounts[i:i + body.size] = body
+        if head + n_body < self.nbin:
+            newcounts[i + body.size] = self.counts[head + n_body:].sum()
         self.counts = newcounts
 
-        self.l2_span += 1
-        self.i_offset //= 2
-        self.i_min //= 2
-        self.i_max //= 2
-        self.check()
+        self.l2_span += levels
+        self.i_offset //= factor
+        self.i_min //= factor
+        self.i_max //= factor
 
     def shift(self, ishift):
         """shifts histogram by shift_counts to the right.
-        Counts and offset are adjusted"""
+        Counts and offset are adjusted. Only the occupied bins are copied,
+        into new counts, so that arrays of the old counts held elsewhere are left as they are."""
         if ishift == 0:
             return
 
-        if ishift < 0:
-            assert not np.any(self.counts[ishift:]), 'bins not emtpy'
-        elif ishift > 0:
-            assert not np.any(self.counts[:ishift]), 'bins not emtpy'
-        self.counts = myroll(self.counts, -ishift)
+        istart = self.i_min - self.i_offset
+        istop = self.i_max - self.i_offset + 1
+        assert istart >= ishift and istop <= self.nbin + ishift, 'bins not emtpy'
+
+        counts = np.zeros(self.nbin, dtype=np.uint32)
+        counts[istart - ishift:istop - ishift] = self.counts[istart:istop]
+        self.counts = counts
         self.i_offset += ishift
-        self.check()
 
     def expand(self, l2_span):
         """if histo is constant, expand it to one with given span"""
@@ -228,6 +313,11 @@ class Hist:
         else:
             assert self.isconst
 
+    def __setstate__(self, state):
+        if 'counts' in state:  # pickled before counts became a property
+            state['_counts'] = state.pop('counts')
+        self.__dict__.update(state)
+
     def __eq__(self, other):
         """only for debugging purposes, this might alter both self and other"""
         if self.isempty and other.isempty:
@@ -293,15 +383,552 @@ class Hist:
         assert self.isexpanded and other.isexpanded
 
         smallest, biggest = sorted([self, other], key=lambda h: h.l2_span)
-        while smallest.l2_span < biggest.l2_span:
-            smallest.enlarge()
-
-        while (max(self.i_max, other.i_max) - min(self.i_min, other.i_min)) >= self.nbin:
-            self.enlarge()
-            other.enlarge()
+        smallest.enlarge(biggest.l2_span - smallest.l2_span)
+
+        i_min = min(self.i_min, other.i_min)
+        i_max = max(self.i_max, other.i_max)
+        levels = 0
+        while (i_max >> levels) - (i_min >> levels) >= self.nbin:
+            levels += 1
+        self.enlarge(levels)
+        other.enlarge(levels)
         assert self.l2_span == other.l2_span
 
         i_offset_new = (min(self.i_min, other.i_min) + max(self.i_max, other.i_max) + 1 - self.nbin) // 2
         self.shift(i_offset_new - self.i_offset)
         other.shift(i_offset_new - other.i_offset)
         assert self.i_offset == other.i_offset
+
+
+class HistBank:
+    """Collection of histograms with the same number of bins, stored as one contiguous (n_keys, nbin) array of counts
+    plus one vector for each piece of metadata (l2_span, i_offset, i_min, i_max, ntot, x_min, x_max). This allows many
+    histograms to be binned, enlarged and merged in a single vectorized call instead of one Hist object at a time. The
+    binning is identical to that of Hist, so single histograms can be taken out as a Hist and put back:
+
+    bank = HistBank(keys)
+    for data in iterator:
+        bank.fill(keys, data)  # data has shape (len(keys), n)
+
+    hist = bank[key]
+    bank[key] += Hist(x)
+
+    The state of a row follows from its data range: empty if ntot == 0, constant if x_min == x_max and expanded
+    otherwise. Only expanded rows have non-zero counts.
+
+    A compact bank is filled and merged in its compact form, only the counts of the rows that are involved are made
+    dense on the way. This suits banks of which most bins stay empty, such as the histograms of a few triggers.
+    """
+
+    FIELDS = ('l2_span', 'i_offset', 'i_min', 'i_max', 'ntot', 'x_min', 'x_max')
+    MERGE_BATCH = 1024  # rows that are merged at a time, to bound the dense counts made for a compact bank
+
+    def __init__(self, keys, l2_nbin=12, compact=False):
+        self.l2_nbin = l2_nbin
+        self.nbin = 2 ** l2_nbin
+
+        self.index = {key: i for i, key in enumerate(keys)}
+        n_keys = len(self.index)
+        if compact:
+            self._counts = None
+            self._sparse = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint32))
+        else:
+            self._counts = np.zeros((n_keys, self.nbin), dtype=np.uint32)
+            self._sparse = None
+        self.l2_span = np.zeros(n_keys, dtype=np.int64)
+        self.i_offset = np.zeros(n_keys, dtype=np.int64)
+        self.i_min = np.zeros(n_keys, dtype=np.int64)
+        self.i_max = np.zeros(n_keys, dtype=np.int64)
+        self.ntot = np.zeros(n_keys, dtype=np.int64)
+        self.x_min = np.full(n_keys, np.inf)
+        self.x_max = np.full(n_keys, -np.inf)
+
+    @property
+    def counts(self):
+        """dense (n_keys, nbin) array of counts, restored from the compact representation if needed"""
+        if self._counts is None:
+            ind, values = self._sparse
+            self._counts = np.zeros((self.ntot.size, self.nbin), dtype=np.uint32)
+            self._counts.reshape(-1)[ind] = values
+            self._sparse = None
+        return self._counts
+
+    @property
+    def iscompact(self):
+        return self._counts is None
+
+    def compact(self):
+        """keeps only the non-zero bins of all histograms as (flat index, count) pairs, so that memory scales with the
+        number of points rather than the number of bins. Histograms can be taken out, filled and merged without
+        restoring the dense counts, which only happens when these are accessed directly."""
+        if not self.iscompact:
+            self._sparse = self._compacted()
+            self._counts = None
+        return self
+
+    def _compacted(self):
+        ind = np.flatnonzero(self._counts)
+        return ind, self._counts.reshape(-1)[ind]
+
+    def __getstate__(self):
+        """pickles the counts in compact form"""
+        state = self.__dict__.copy()
+        if not self.iscompact:
+            state['_sparse'] = self._compacted()
+            state['_counts'] = None
+        return state
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def keys(self):
+        return self.index.keys()
+
+    def __repr__(self):
+        return 'bank of %i histograms with %i bins' % (len(self), self.nbin)
+
+    def rows(self, keys):
+        """row indices of the given keys"""
+        return np.fromiter((self.index[key] for key in keys), dtype=np.int64)
+
+    def isempty(self, rows):
+        return self.ntot[rows] == 0
+
+    def isconst(self, rows):
+        return (self.ntot[rows] > 0) & (self.x_min[rows] == self.x_max[rows])
+
+    def isexpanded(self, rows):
+        return (self.ntot[rows] > 0) & (self.x_min[rows] < self.x_max[rows])
+
+    def __getitem__(self, key):
+        """returns a copy of a single histogram as a Hist"""
+        i = self.index[key]
+        counts, compact = None, None
+        if not self.iscompact:
+            counts = self._counts[i].copy()
+        else:
+            ind, values = self._sparse
+            start, stop = np.searchsorted(ind, (i * self.nbin, (i + 1) * self.nbin))
+            bins = ind[start:stop] - i * self.nbin - (self.i_min[i] - self.i_offset[i])
+            compact = (bins.astype(np.uint32), values[start:stop])
+        return Hist.from_state(l2_nbin=self.l2_nbin,
+                               ntot=self.ntot[i],
+                               x_min=self.x_min[i],
+                               x_max=self.x_max[i],
+                               l2_span=self.l2_span[i],
+                               i_offset=self.i_offset[i],
+                               i_min=self.i_min[i],
+                               i_max=self.i_max[i],
+                               counts=counts,
+                               compact=compact)
+
+    def __setitem__(self, key, hist):
+        """stores a Hist in the row of key, overwriting its previous contents"""
+        assert hist.nbin == self.nbin
+        i = self.index[key]
+        counts = np.zeros((1, self.nbin), dtype=np.uint32)
+        self.ntot[i] = hist.ntot
+        if hist.isempty:
+            self.x_min[i], self.x_max[i] = np.inf, -np.inf
+        elif hist.isconst:
+            self.x_min[i] = self.x_max[i] = hist.const_val
+        else:
+            self.x_min[i], self.x_max[i] = hist.x_min, hist.x_max
+            self.l2_span[i] = hist.l2_span
+            self.i_offset[i] = hist.i_offset
+            self.i_min[i] = hist.i_min
+            self.i_max[i] = hist.i_max
+            if hist.x_min < hist.x_max:  # an expanded constant histogram is stored as constant again
+                counts[0] = hist.counts
+        self._set_counts(np.array([i]), counts)
+
+    def __delitem__(self, key):
+        i = self.index.pop(key)
+        self._set_counts(np.array([i]), np.zeros((1, self.nbin), dtype=np.uint32))
+        self.ntot[i] = 0
+        self.x_min[i], self.x_max[i] = np.inf, -np.inf
+
+    def fill(self, keys, x: np.ndarray, mask=None, workspace=None):
+        """bins row i of the 2d array x into the histogram of keys[i], using only the samples selected by mask if it
+        is given. Like in Hist, NaNs are replaced by the mean of their row, which modifies x in place.
+        Returns the bin indices of all samples of x at the span of their row, together with these spans (NO_SPAN for
+        rows that are not expanded), so that subsets of x can be binned with fill_grouped without doing it again.
+        With a Workspace, the bin indices and temporaries are kept in its buffers instead of new arrays, so the
+        returned indices are only valid until the next fill with the same workspace."""
+        rows = self.rows(keys)
+        assert x.ndim == 2 and x.shape[0] == rows.size
+        assert x.shape[1] < 2 ** 32
+        l2_span = np.full(rows.size, NO_SPAN)
+        ntot = x.shape[1] if mask is None else np.count_nonzero(mask)
+        if not ntot:
+            return None, l2_span
+
+        where = True if mask is None else mask
+        x_min = np.min(x, axis=1, where=where, initial=np.inf)
+        x_max = np.max(x, axis=1, where=where, initial=-np.inf)
+        for i in np.flatnonzero(~np.isfinite(x_max - x_min)):
+            x_i = x[i] if mask is None else x[i, mask]
+            assert not np.isnan(x_i).all(), "Array of only NaNs encountered"
+            x[i] = np.nan_to_num(x[i], copy=False, nan=np.nanmean(x_i))
+            x_min[i] = np.min(x[i], where=where, initial=np.inf)
+            x_max[i] = np.max(x[i], where=where, initial=-np.inf)
+
+        self._update(rows, x_min, x_max, ntot=ntot)
+
+        expanded = self.isexpanded(rows)
+        rows = rows[expanded]
+        l2_span[expanded] = self.l2_span[rows]
+        if expanded.all() and workspace is not None:
+            ind = myfloor(x, (self.l2_nbin - l2_span)[:, None],
+                          out=workspace.get('ind', x.shape, np.int64), tmp=workspace.get('scaled', x.shape))
+            self._add_indices_masked(rows, ind, mask, out=workspace.get('local', x.shape, np.int64))
+            return ind, l2_span
+        elif expanded.all():
+            ind = myfloor(x, (self.l2_nbin - l2_span)[:, None])
+        else:
+            ind = np.zeros(x.shape, dtype=np.int64)
+            ind[expanded] = myfloor(x[expanded], (self.l2_nbin - l2_span[expanded])[:, None])
+
+        local = ind[expanded] - self.i_offset[rows, None]
+        self._add_indices(rows, local if mask is None else local[:, mask])
+        return ind, l2_span
+
+    def fill_grouped(self, keys, x: np.ndarray, codes, ind=None, l2_span=None):
+        """bins the columns of the 2d array x into one histogram per group: column j of row i is added to the
+        histogram of keys[i][codes[j]]. If the bin indices and spans of x are given, as returned by fill, they are
+        reused instead of binning x again (except for rows without span). All groups are binned in a single
+        bincount with group-coded indices."""
+        rows = np.array([self.rows(k) for k in keys]).reshape(len(keys), -1)
+        n_rows, n_groups = rows.shape
+        assert x.shape == (n_rows, codes.size)
+        if not codes.size:
+            return
+
+        ntot = np.bincount(codes, minlength=n_groups)
+        present = np.flatnonzero(ntot)
+        order = np.argsort(codes, kind='stable')
+        starts = (np.cumsum(ntot) - ntot)[present]
+        x_sorted = x[:, order]
+        x_min = np.minimum.reduceat(x_sorted, starts, axis=1)
+        x_max = np.maximum.reduceat(x_sorted, starts, axis=1)
+        assert np.isfinite(x_max - x_min).all(), "Non-finite values encountered"
+
+        if ind is None:
+            l2_span = np.full(n_rows, NO_SPAN)
+        self._update(rows[:, present].ravel(), x_min.ravel(), x_max.ravel(),
+                     ntot=np.tile(ntot[present], n_rows),
+                     l2_span=np.repeat(l2_span, present.size))
+
+        expanded = self.isexpanded(rows)
+        span = self.l2_span[rows][:, codes]
+        local = np.empty(x.shape, dtype=np.int64)
+        reuse = l2_span != NO_SPAN
+        if reuse.any():
+            levels = np.maximum(span[reuse] - l2_span[reuse, None], 0)
+            local[reuse] = ind[reuse] >> levels
+        if not reuse.all():
+            local[~reuse] = myfloor(x[~reuse], self.l2_nbin - span[~reuse])
+        local -= self.i_offset[rows][:, codes]
+
+        code = (np.arange(n_rows)[:, None] * n_groups + codes) * self.nbin + local
+        counts = np.bincount(code[expanded[:, codes]], minlength=rows.size * self.nbin)
+        counts = counts.reshape(n_rows, n_groups, self.nbin)
+        self._add_counts(rows[expanded], counts[expanded])
+
+    def enlarge(self, keys, levels=1):
+        """increase the span of the given (expanded) histograms by 2**levels and merge bins"""
+        rows = self.rows(keys)
+        assert self.isexpanded(rows).all()
+        l2_span, i_offset = self.l2_span[rows] + levels, self.i_offset[rows] >> levels
+        self._rebin(rows, l2_span, i_offset)
+        self.l2_span[rows] = l2_span
+        self.i_offset[rows] = i_offset
+        self.i_min[rows] >>= levels
+        self.i_max[rows] >>= levels
+
+    def __iadd__(self, other):
+        """merges the histograms of other into the histograms with the same key in self. Keys that are missing in
+        self are ignored, other is not modified."""
+        return self.merge(other)
+
+    def merge(self, other, keys=None, other_keys=None):
+        """merges the histograms of other_keys in other into the histograms of keys in self, by default for all keys
+        that are in both. other is not modified."""
+        assert self.nbin == other.nbin
+        if keys is None:
+            keys = other_keys = [key for key in other.keys() if key in self.index]
+        rows, other_rows = self.rows(keys), other.rows(other_keys)
+        nonempty = other.ntot[other_rows] > 0
+        rows, other_rows = rows[nonempty], other_rows[nonempty]
+
+        for i in range(0, rows.size, self.MERGE_BATCH):
+            r, o = rows[i:i + self.MERGE_BATCH], other_rows[i:i + self.MERGE_BATCH]
+            self._update(r, other.x_min[o], other.x_max[o], ntot=other.ntot[o],
+                         l2_span=np.where(other.isexpanded(o), other.l2_span[o], NO_SPAN))
+            self._add_counts(r, self._binned_from(r, other, o))
+        return self
+
+    def take(self, keys):
+        """returns a new bank with copies of the histograms of keys"""
+        rows = self.rows(keys)
+        bank = HistBank(keys, l2_nbin=self.l2_nbin)
+        bank.counts[:] = self._counts_of(rows)
+        for field in self.FIELDS:
+            getattr(bank, field)[:] = getattr(self, field)[rows]
+        return bank
+
+    def aligned_counts(self, keys, other, other_keys):
+        """
+        returns the counts of keys in self and of other_keys in other as two (n, nbin) arrays that are aligned row by
+        row, i.e. binned with a common span and offset, as Hist.align does for a single pair. Neither bank is
+        modified. The returned mask tells which rows can be compared: those where both histograms are non-empty and
+        not both constant with the same value.
+        """
+        assert self.nbin == other.nbin
+        aligned = self.take(keys)
+        rows, other_rows = np.arange(len(aligned)), other.rows(other_keys)
+        valid = (aligned.ntot > 0) & (other.ntot[other_rows] > 0)
+
+        aligned._update(rows, other.x_min[other_rows], other.x_max[other_rows], ntot=0,
+                        l2_span=np.where(other.isexpanded(other_rows), other.l2_span[other_rows], NO_SPAN))
+        valid &= aligned.isexpanded(rows)
+        return aligned.counts, aligned._binned_from(rows, other, other_rows), valid
+
+    def _binned_from(self, rows, other, other_rows):
+        """counts of other_rows in other, binned with the span and offset of rows in self, which must fit them. Rows
+        where either histogram is not expanded are zero."""
+        counts = np.zeros((rows.size, self.nbin), dtype=np.uint32)
+        expanded = self.isexpanded(rows)
+
+        src = expanded & other.isexpanded(other_rows)
+        if src.any():
+            counts[src] = self._binned(counts=other._counts_of(other_rows[src]),
+                                       l2_span=other.l2_span[other_rows[src]],
+                                       i_offset=other.i_offset[other_rows[src]],
+                                       new_l2_span=self.l2_span[rows[src]],
+                                       new_i_offset=self.i_offset[rows[src]])
+        src = expanded & other.isconst(other_rows)
+        if src.any():
+            ind = myfloor(other.x_min[other_rows[src]], self.l2_nbin - self.l2_span[rows[src]])
+            counts[np.flatnonzero(src), ind - self.i_offset[rows[src]]] = other.ntot[other_rows[src]]
+        return counts
+
+    def _counts_of(self, rows):
+        """dense counts of rows, taken from the compact representation without restoring all dense counts"""
+        if not self.iscompact:
+            return self._counts[rows]
+
+        ind, values = self._sparse
+        selection, lengths = self._sparse_selection(rows)
+        counts = np.zeros((rows.size, self.nbin), dtype=np.uint32)
+        shift = np.repeat((rows - np.arange(rows.size)) * self.nbin, lengths)
+        counts.reshape(-1)[ind[selection] - shift] = values[selection]
+        return counts
+
+    def _sparse_selection(self, rows):
+        """positions of the compact counts of rows, row after row, and the number of counts of every row"""
+        ind, _ = self._sparse
+        start = np.searchsorted(ind, rows * self.nbin)
+        lengths = np.searchsorted(ind, (rows + 1) * self.nbin) - start
+        selection = np.arange(lengths.sum()) + np.repeat(start - (np.cumsum(lengths) - lengths), lengths)
+        return selection, lengths
+
+    def _set_counts(self, rows, counts):
+        """replaces the counts of the (unique) rows, in the compact representation without restoring all dense
+        counts. The compact counts of the rows are spliced out and the new ones in at the same place, so the rest
+        stays sorted as it is."""
+        if not self.iscompact:
+            self._counts[rows] = counts
+            return
+
+        ind, values = self._sparse
+        order = np.argsort(rows)
+        rows, counts = rows[order], counts[order]
+        selection, lengths = self._sparse_selection(rows)
+        new = np.flatnonzero(counts)
+        # position of the new counts of every row among the counts that are kept
+        at = np.searchsorted(ind, rows * self.nbin) - (np.cumsum(lengths) - lengths)
+        at = np.repeat(at, np.bincount(new // self.nbin, minlength=rows.size))
+        self._sparse = (np.insert(np.delete(ind, selection), at, rows[new // self.nbin] * self.nbin + new % self.nbin),
+                        np.insert(np.delete(values, selection), at, counts.reshape(-1)[new].astype(np.uint32)))
+
+    def _add_counts(self, rows, counts):
+        """adds counts to the counts of the (unique) rows"""
+        if not self.iscompact:
+            self._counts[rows] += counts.astype(np.uint32, copy=False)
+        elif rows.size:
+            self._set_counts(rows, self._counts_of(rows) + counts.astype(np.uint32, copy=False))
+
+    def sparse_counts(self, rows):
+        """
+        non-zero counts of rows in compressed sparse row format, taken from the compact representation without
+        restoring the dense counts
+
+        :return: (indptr, bins, values), with the counts of rows[i] in values[indptr[i]:indptr[i + 1]] and their bins
+            in bins[indptr[i]:indptr[i + 1]]
+        """
+        if not self.iscompact:
+            counts = self._counts[rows]
+            row, bins = np.nonzero(counts)
+            return np.concatenate(([0], np.cumsum(np.bincount(row, minlength=rows.size)))), bins, counts[row, bins]
+
+        ind, values = self._sparse
+        selection, lengths = self._sparse_selection(rows)
+        return np.concatenate(([0], np.cumsum(lengths))), ind[selection] % self.nbin, values[selection]
+
+    def set_sparse_counts(self, indptr, bins, values):
+        """replaces the counts of rows 0, 1, ... with counts in the format returned by sparse_counts, where the bins of
+        every row are in increasing order. A compact bank takes them over without making dense counts."""
+        ind = np.repeat(np.arange(len(indptr) - 1) * self.nbin, np.diff(indptr)) + bins.astype(np.int64)
+        if self.iscompact:
+            self._sparse = ind, values.astype(np.uint32)
+        else:
+            self._counts[:] = 0
+            self._counts.reshape(-1)[ind] = values
+
+    def check(self, keys=None):
+        """checks various invariants of internal state of all histograms, or only those of the given keys"""
+        rows = self.rows(self.index if keys is None else keys)
+
+        empty = self.isempty(rows)
+        assert (self.x_min[rows[empty]] == np.inf).all()
+        assert (self.x_max[rows[empty]] == -np.inf).all()
+        assert not self.counts[rows[~self.isexpanded(rows)]].any()
+
+        rows = rows[self.isexpanded(rows)]
+        istart = self.i_min[rows] - self.i_offset[rows]
+        istop = self.i_max[rows] - self.i_offset[rows]
+        assert ((0 <= istart) & (istart < self.nbin)).all()
+        assert ((0 <= istop) & (istop < self.nbin)).all()
+        assert (self.counts[rows, istart] > 0).all()
+        assert (self.counts[rows, istop] > 0).all()
+        j = np.arange(self.nbin)
+        outside = (j < istart[:, None]) | (j > istop[:, None])
+        assert not (self.counts[rows] * outside).any()
+        assert (self.ntot[rows] == self.counts[rows].sum(axis=1)).all()
+
+    def _update(self, rows, x_min, x_max, ntot, l2_span=None):
+        """prepares rows for merging new data with range [x_min, x_max]: chooses a common span and offset that fit
+        both the existing and the new data, moves the existing counts accordingly and updates the metadata. The new
+        data must be added to counts by the caller. If the new data is already binned, l2_span gives the span it was
+        binned with (NO_SPAN if it is not). The span is chosen as in Hist.align: the larger of the two spans, enlarged
+        until the merged data fit."""
+        new_expanded = x_min < x_max
+        x_min_new, x_max_new = x_min, x_max
+        x_min = np.minimum(self.x_min[rows], x_min)
+        x_max = np.maximum(self.x_max[rows], x_max)
+        expanded = x_min < x_max
+        was_expanded = self.isexpanded(rows)[expanded]
+        new_expanded = new_expanded[expanded]
+        r = rows[expanded]
+
+        margin = (self.nbin + 2) / self.nbin
+        with np.errstate(over='ignore', divide='ignore', invalid='ignore'):
+            # the span of a new Hist of the data, or of two constants expanded into one as in Hist.align
+            l2_span_new = np.where(new_expanded, np.ceil(np.log2((x_max_new - x_min_new)[expanded] * margin)),
+                                   np.ceil(np.log2(x_max[expanded] - x_min[expanded])))
+        if l2_span is not None:
+            binned = new_expanded & (l2_span[expanded] != NO_SPAN)
+            l2_span_new[binned] = l2_span[expanded][binned]
+        l2_span_new[was_expanded & ~new_expanded] = -np.inf  # a constant takes the span of the histogram it joins
+        if not np.isfinite(l2_span_new[~was_expanded | new_expanded]).all():
+            raise OverflowError('cannot convert float infinity to integer')  # as int() does in Hist
+        l2_span_new[was_expanded] = np.maximum(l2_span_new[was_expanded], self.l2_span[r[was_expanded]])
+        l2_span_new = l2_span_new.astype(np.int64)
+
+        i_min = myfloor(x_min[expanded], self.l2_nbin - l2_span_new)
+        i_max = myfloor(x_max[expanded], self.l2_nbin - l2_span_new)
+        too_wide = i_max - i_min >= self.nbin
+        while too_wide.any():
+            l2_span_new[too_wide] += 1
+            i_min[too_wide] >>= 1
+            i_max[too_wide] >>= 1
+            too_wide = i_max - i_min >= self.nbin
+        if i_min.size and max(i_max.max(), -i_min.min()) > flintmax:
+            raise ValueError('Data are badly scaled')
+
+        # keep the current offset if the merged data still fit, to avoid moving the counts around
+        i_offset = self.i_offset[r]
+        keep = was_expanded & (self.l2_span[r] == l2_span_new) & (i_offset <= i_min) & (i_max < i_offset + self.nbin)
+        i_offset_new = np.where(keep, i_offset, (i_min + i_max + 1 - self.nbin) // 2)
+
+        self._rebin(r, l2_span_new, i_offset_new)
+        self.l2_span[r] = l2_span_new
+        self.i_offset[r] = i_offset_new
+        self.i_min[r] = i_min
+        self.i_max[r] = i_max
+        self.x_min[rows] = x_min
+        self.x_max[rows] = x_max
+        self.ntot[rows] += ntot
+
+    def _rebin(self, rows, l2_span, i_offset):
+        """moves the counts of rows to a new span and offset, expanding constant histograms"""
+        expanded = self.isexpanded(rows)
+        move = expanded & ((self.l2_span[rows] != l2_span) | (self.i_offset[rows] != i_offset))
+        if move.any():
+            r = rows[move]
+            self._set_counts(r, self._binned(counts=self._counts_of(r),
+                                             l2_span=self.l2_span[r],
+                                             i_offset=self.i_offset[r],
+                                             new_l2_span=l2_span[move],
+                                             new_i_offset=i_offset[move]))
+
+        const = self.isconst(rows)
+        if const.any():
+            r = rows[const]
+            ind = myfloor(self.x_min[r], self.l2_nbin - l2_span[const])
+            counts = np.zeros((r.size, self.nbin), dtype=np.uint32)  # constant rows have no counts yet
+            counts[np.arange(r.size), ind - i_offset[const]] = self.ntot[r]
+            self._set_counts(r, counts)
+
+    def _binned(self, counts, l2_span, i_offset, new_l2_span, new_i_offset):
+        """returns the 2d array of counts, binned with a larger or equal span and another offset, in a single pass.
+        All occupied bins are assumed to fit in the new span. Rows that keep their span are only shifted."""
+        levels = new_l2_span - l2_span
+        assert (levels >= 0).all()
+        binned = np.empty_like(counts)
+
+        shifted = levels == 0
+        if shifted.any():
+            ind = np.arange(self.nbin) + (new_i_offset - i_offset)[shifted, None]
+            outside = (ind < 0) | (ind >= self.nbin)
+            np.clip(ind, 0, self.nbin - 1, out=ind)
+            binned[shifted] = np.take_along_axis(counts[shifted], ind, axis=1)
+            binned[shifted] *= ~outside
+
+        if not shifted.all():
+            merged = ~shifted
+            ind = (i_offset[merged, None] + np.arange(self.nbin)) >> levels[merged, None]
+            ind -= new_i_offset[merged, None]
+            np.clip(ind, 0, self.nbin - 1, out=ind)  # only empty bins can fall outside
+            binned[merged] = self._bincount(ind, weights=counts[merged])
+        return binned
+
+    def _add_indices(self, rows, ind):
+        """adds the bin indices (relative to i_offset) in row i of ind to the histogram in rows[i]"""
+        self._add_counts(rows, self._bincount(ind))
+
+    def _add_indices_masked(self, rows, ind, mask, out):
+        """adds the bin indices (at the span of each row) in row i of ind to the histogram in rows[i], using only the
+        samples selected by mask. The row-coded local indices are made in out, masked samples go to a spare bin."""
+        n_bins = rows.size * self.nbin
+        np.subtract(ind, (self.i_offset[rows] - np.arange(rows.size) * self.nbin)[:, None], out=out)
+        if mask is not None:
+            out[:, ~mask] = n_bins
+        counts = np.bincount(out.ravel(), minlength=n_bins + 1)[:n_bins]
+        self._add_counts(rows, counts.reshape(rows.size, self.nbin))
+
+    def _bincount(self, ind, weights=None):
+        """row-wise bincount of a 2d array of bin indices, done as one bincount with row-coded indices"""
+        n_rows = ind.shape[0]
+        ind = ind + (np.arange(n_rows) * self.nbin)[:, None]
+        if weights is not None:
+            weights = weights.ravel()
+        counts = np.bincount(ind.ravel(), weights=weights, minlength=n_rows * self.nbin)
+        return counts.reshape(n_rows, self.nbin).astype(np.uint32)
@@ -2,9 +2,12 @@
     Data transformations.
 """
 
+import copy
+
 import matplotlib.pyplot as plt
 import numpy as np
 import scipy.signal as sig
+from scipy.fft import next_fast_len, rfft, irfft
 
 from application.config import config_manager
 
@@ -12,13 +15,36 @@ LOG = config_manager.get_logger(__name__)
 
 
 class Transformation:
+    """
+    Transformations work along the last axis, so x is the data of a single channel or a (channels, samples) block of
+    channels. Stateful transformations keep their state as arrays with a row per channel, rows selects the state rows
+    of the rows of x (by default rows 0, 1, ...). Transformations that work element-wise write their result to out if
+    it is given, others return a new array. Transformations that need data past the end of a block get the first
+    lookahead samples of the next block as lookahead, or None after the last block before a gap.
+    """
+    STREAMING = True  # whether calculating block by block gives the same result as calculating all data at once
+    lookahead = 0  # number of samples of the next block that calculate needs
+
+    def init_state(self, n_channels):
+        pass
 
     def calculate(self, *x):
         raise NotImplementedError
 
-    def reset(self):
+    def reset(self, rows=None):
+        """resets the state of the given rows, or of all channels"""
         pass
 
+    def get_settings(self):
+        """the scalar parameters of the transformation, which tell results of different settings apart"""
+        return {name: value for name, value in vars(self).items() if isinstance(value, (bool, int, float, str))}
+
+
+def state_rows(x, rows):
+    """x as a 2d block, with the state rows of its rows"""
+    x = np.atleast_2d(x)
+    return x, np.arange(x.shape[0]) if rows is None else rows
+
 
 def abs_norm(x):
     """
@@ -32,6 +58,7 @@ def abs_norm(x):
 
 class CentralDifferenceDifferentiator(Transformation):
     NAME = 'centraldiff'
+    STREAMING = False
 
     FILTER_ORDER = 3
 
@@ -44,8 +71,56 @@ class CentralDifferenceDifferentiator(Transformation):
         return np.gradient(y, np.linspace(x_min, x_max, len(y)), edge_order=2)
 
 
+class FFTConvolver:
+    """
+    convolves blocks of data with a fixed kernel through the FFT, in O(n log n). The spectrum of the kernel is cached
+    per FFT size, so blocks of the same size reuse it. Contiguous blocks are filtered as one signal by overlap-add: the
+    part of the convolution of a block that runs past its end is carried to the next block as tail, and the part of
+    the next block that runs back into the current one is added from its first offset samples, given as lookahead.
+    Data before the first block and after the last one is taken as zero, as in np.convolve(x, kernel, mode='same').
+    """
+
+    def __init__(self, kernel):
+        self.kernel = np.asarray(kernel, dtype=float)
+        self.offset = (self.kernel.size - 1) // 2
+        self.spectra = {}
+
+    def get_spectrum(self, n_fft):
+        if n_fft not in self.spectra:
+            self.spectra[n_fft] = rfft(self.kernel, n_fft)
+        return self.spectra[n_fft]
+
+    def convolve_full(self, x):
+        """:return: the full convolution of x along the last axis, as with mode='full'"""
+        n_full = x.shape[-1] + self.kernel.size - 1
+        n_fft = next_fast_len(n_full, real=True)
+        spectrum = rfft(x, n_fft)
+        spectrum *= self.get_spectrum(n_fft)
+        return irfft(spectrum, n_fft, overwrite_x=True)[..., :n_full]
+
+    def convolve(self, x, tail=None, lookahead=None):
+        """
+        :param x: block of data, convolved along the last axis
+        :param tail: tail returned for the previous block, or None at the start of the data
+        :param lookahead: the first offset samples of the next block, or None at the end of the data. Blocks shorter
+            than offset only get the look-ahead of a single block.
+        :return: convolution of x centered as with mode='same', tail for the next block
+        """
+        n = x.shape[-1]
+        full = self.convolve_full(x)
+        if tail is not None:
+            full[..., :tail.shape[-1]] += tail
+        tail = full[..., n:].copy()
+        x_conv = full[..., self.offset:self.offset + n]
+        if lookahead is not None:
+            head = self.convolve_full(lookahead[..., :self.offset])[..., :self.offset]
+            x_conv[..., max(n - self.offset, 0):] += head[..., max(self.offset - n, 0):]
+        return x_conv, tail
+
+
 class GaussianDifferentiator(Transformation):
     NAME = 'gauss'
+    STREAMING = False
 
     def __init__(self, n_points, kernel_n_sigma=2, sigma=1, order=1, **kwargs):
         """
@@ -61,6 +136,12 @@ class GaussianDifferentiator(Transformation):
         self.kernel_width = kernel_n_sigma * sigma
         self.sigma = sigma
         self.kernel = self._get_kernel(order=order)
+        self.convolver = FFTConvolver(self.kernel)
+        self.tail = None  # (channels, len(kernel) - 1) part of the convolution that runs into the next block
+
+    @property
+    def lookahead(self):
+        return self.convolver.offset
 
     def _get_kernel(self, order):
         x = np.linspace(-self.kernel_width, self.kernel_width, self.n_points)
@@ -75,16 +156,33 @@ class GaussianDifferentiator(Transformation):
             LOG.error(f'Gaussian filter order {order} not implemented. Available options: [1, 2]')
             raise ValueError
 
-    def calculate(self, x):
-        return np.convolve(x, self.kernel, mode='same')
+    def init_state(self, n_channels):
+        self.tail = np.zeros((n_channels, self.kernel.size - 1))
+
+    def calculate(self, x, rows=None, out=None, lookahead=None):
+        """contiguous blocks are filtered as one signal: the tail of the previous block is carried over until reset,
+        and the start of the next block is taken from lookahead. The output of a block can therefore only be
+        calculated once the next block is read."""
+        x_2d, rows = state_rows(x, rows)
+        if self.tail is None:
+            self.init_state(x_2d.shape[0])
+        x_trans, self.tail[rows] = self.convolver.convolve(x_2d, tail=self.tail[rows], lookahead=lookahead)
+        return x_trans.reshape(x.shape)
+
+    def reset(self, rows=None):
+        if self.tail is not None:
+            self.tail[slice(None) if rows is None else rows] = 0
 
 
 class SavitzkyGolayDifferentiator(Transformation):
     NAME = 'savitzkygolay'
+    STREAMING = False
 
     POLYNOMIAL_ORDER = 10
     PADDING_MODE = 'wrap'
 
+    coefficients = {}  # (window_length, order, dx): filter coefficients, the same for every channel
+
     def __init__(self, window_length, dx, order=1, **kwargs):
         """
 
@@ -92,15 +190,36 @@ class SavitzkyGolayDifferentiator(Transformation):
         :param order: nd derivative order
         :param dx: spacing between samples
         """
-        self.window_length = window_length
+        self.window_length = int(window_length)
         self.order = order
         self.dx = dx
+        self.spectra = {}
 
-    def calculate(self, x):
-        return sig.savgol_filter(x, self.window_length,
-                                 polyorder=self.POLYNOMIAL_ORDER,
-                                 deriv=self.order,
-                                 delta=self.dx)
+    def get_coefficients(self):
+        key = (self.window_length, self.order, self.dx)
+        if key not in self.coefficients:
+            self.coefficients[key] = sig.savgol_coeffs(self.window_length, self.POLYNOMIAL_ORDER,
+                                                       deriv=self.order, delta=self.dx, use='conv')
+        return self.coefficients[key]
+
+    def get_spectrum(self, n):
+        """
+        spectrum of the filter as a circular kernel of n samples. Padding by wrapping extends the data periodically,
+        so filtering equals the circular convolution, with coefficients that wrap around more than once summed.
+        """
+        if n not in self.spectra:
+            kernel = np.zeros(n)
+            np.add.at(kernel, (np.arange(self.window_length) - self.window_length // 2) % n, self.get_coefficients())
+            self.spectra[n] = rfft(kernel)
+        return self.spectra[n]
+
+    def calculate(self, x, rows=None, out=None):
+        """same as sig.savgol_filter(x, ..., mode=PADDING_MODE), applied through the FFT along the last axis, so x can
+        be a block of channels"""
+        n = x.shape[-1]
+        spectrum = rfft(x, axis=-1)
+        spectrum *= self.get_spectrum(n)
+        return irfft(spectrum, n, axis=-1, overwrite_x=True)
 
 
 class Abs(Transformation):
@@ -109,12 +228,13 @@ class Abs(Transformation):
     def __init__(self, **kwargs):
         pass
 
-    def calculate(self, x):
-        return np.abs(x)
+    def calculate(self, x, rows=None, out=None):
+        return np.abs(x, out=out)
 
 
 class AbsMean(Transformation):
     NAME = 'absmean'
+    STREAMING = False
 
     def __init__(self, **kwargs):
         """
@@ -123,17 +243,26 @@ class AbsMean(Transformation):
         """
         self.mean = kwargs.pop("mean", 0)
         self.means = []
+        self.offsets = None  # (channels,) offset per channel, NaN where the mean of the data is used
 
-    def calculate(self, x):
-        if not self.mean:
-            mean = np.mean(x)
-            self.means.append(mean)
-            return np.abs(x - mean)
-        else:
-            return np.abs(x - self.mean)
+    def init_state(self, n_channels):
+        self.offsets = np.full(n_channels, self.mean or np.nan)
 
-    def reset(self):
-        self.mean = None
+    def calculate(self, x, rows=None, out=None):
+        x_2d, rows = state_rows(x, rows)
+        if self.offsets is None:
+            self.init_state(x_2d.shape[0])
+        offsets = self.offsets[rows]
+        unset = np.isnan(offsets)
+        if unset.any():
+            offsets[unset] = np.mean(x_2d[unset], axis=-1)
+            self.means.append(offsets[unset])
+        x_trans = np.subtract(x_2d, offsets[:, None], out=None if out is None else out.reshape(x_2d.shape))
+        return np.abs(x_trans, out=x_trans).reshape(x.shape)
+
+    def reset(self, rows=None):
+        if self.offsets is not None:
+            self.offsets[slice(None) if rows is None else rows] = np.nan
 
 
 class Differentiator(Transformation):
@@ -146,17 +275,33 @@ class Differentiator(Transformation):
         f_nyquist = f_target / 2
         f_critical = self.FREQUENCY_CUTOFF / f_nyquist
         self.B, self.A = sig.butter(self.FILTER_ORDER, f_critical, btype='highpass', fs=f_target)
+        # lfiltic is linear in the initial output and input, so the initial state of many channels is a sum of two
+        # outer products
+        self.zi_y = sig.lfiltic(self.B, self.A, [1], [0])
+        self.zi_x = sig.lfiltic(self.B, self.A, [0], [1])
+
+        self.zi = None  # (channels, filter order) filter state
+        self.fresh = None  # (channels,) whether the filter of a channel starts at its next block
 
-        self.zi = None
+    def init_state(self, n_channels):
+        self.zi = np.zeros((n_channels, self.zi_y.size))
+        self.fresh = np.ones(n_channels, dtype=bool)
 
-    def calculate(self, x):
+    def calculate(self, x, rows=None, out=None):
+        x_2d, rows = state_rows(x, rows)
         if self.zi is None:
-            self.zi = sig.lfiltic(self.B, self.A, [self.B[0] * (x[1] - x[0])], [2 * x[0] - x[1]])
-        x_trans, self.zi = sig.lfilter(self.B, self.A, x, zi=self.zi)
-        return x_trans
+            self.init_state(x_2d.shape[0])
+        zi, fresh = self.zi[rows], self.fresh[rows]
+        if fresh.any():
+            x_0, x_1 = x_2d[fresh, 0], x_2d[fresh, 1]
+            zi[fresh] = np.outer(self.B[0] * (x_1 - x_0), self.zi_y) + np.outer(2 * x_0 - x_1, self.zi_x)
+        x_trans, self.zi[rows] = sig.lfilter(self.B, self.A, x_2d, axis=-1, zi=zi)
+        self.fresh[rows] = False
+        return x_trans.reshape(x.shape)
 
-    def reset(self):
-        self.zi = None
+    def reset(self, rows=None):
+        if self.fresh is not None:
+            self.fresh[slice(None) if rows is None else rows] = True
 
 
 def do_transformations(transformations: [Transformation], data):
@@ -166,6 +311,61 @@ def do_transformations(transformations: [Transformation], data):
     return transformed_data
 
 
+class TransformationTree:
+    """
+    transformation combinations compiled into a prefix tree. Combinations that start with the same transformations
+    share the nodes of that prefix, so it is calculated once and its output is passed on to every continuation.
+    Transformations are given as instances or as classes, the same instance or class at the same depth after the same
+    prefix is a shared node.
+    """
+
+    def __init__(self, combinations):
+        self.nodes = []  # (index of the parent node or -1 for the input data, transformation), parents come first
+        self.outputs = []  # index of the node with the output of every combination, -1 for the input data
+        index = {}
+        for combination in combinations:
+            node, prefix = -1, ()
+            for transformation in combination:
+                prefix += (transformation,)
+                if prefix not in index:
+                    index[prefix] = len(self.nodes)
+                    self.nodes.append((node, transformation))
+                node = index[prefix]
+            self.outputs.append(node)
+
+    def instantiate(self, n_channels, **kwargs):
+        """
+        :return: transformations of the nodes with state for n_channels. Classes are instantiated with kwargs and
+            instances are copied, so that the state of the originals is not shared.
+        """
+        transformations = [t(**kwargs) if isinstance(t, type) else copy.copy(t) for _, t in self.nodes]
+        for (parent, _), transformation in zip(self.nodes, transformations):
+            assert parent < 0 or not transformation.lookahead, 'only the first transformation can look ahead'
+            transformation.init_state(n_channels)
+        return transformations
+
+    def get_settings(self, **kwargs):
+        """:return: the parent, name and settings of every node, with classes as they are instantiated with kwargs"""
+        return [(parent, t.NAME, (t(**kwargs) if isinstance(t, type) else t).get_settings()) for parent, t in self.nodes]
+
+    def calculate(self, transformations, data, rows=None, workspace=None, lookahead=None):
+        """
+        :param transformations: transformations of the nodes, as returned by instantiate
+        :param data: (channels, samples) block
+        :param rows: state rows of the channels in data
+        :param workspace: Workspace with the output buffers of the nodes
+        :param lookahead: (channels, samples) start of the next block, for transformations that look ahead
+        :return: transformed data of every combination
+        """
+        results = []
+        for i, ((parent, _), transformation) in enumerate(zip(self.nodes, transformations)):
+            out = workspace.get(f'node_{i}', data.shape) if workspace is not None else None
+            kwargs = {'lookahead': lookahead} if transformation.lookahead else {}
+            results.append(transformation.calculate(x=data if parent < 0 else results[parent], rows=rows, out=out,
+                                                    **kwargs))
+        return [data if node < 0 else results[node] for node in self.outputs]
+
+
 if __name__ == '__main__':
     n = 5000
     xdata = np.linspace(-np.pi, np.pi, n)
@@ -0,0 +1,28 @@
+"""
+    Reusable buffers of a worker, so that the hot loop does not allocate full-length arrays per channel and block.
+"""
+
+import numpy as np
+
+
+class Workspace:
+    """
+    A buffer is allocated the first time it is requested and reused by every later request with the same name and
+    dtype. Requests for a smaller shape, such as a shorter last block or batch, get a view of the existing buffer, so
+    buffers are sized once per segment length. The contents of a buffer are only valid until it is requested again.
+    """
+
+    def __init__(self):
+        self.buffers = {}
+
+    def get(self, name, shape, dtype=float):
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape))
+        buffer = self.buffers.get((name, dtype))
+        if buffer is None or buffer.size < size:
+            buffer = self.buffers[name, dtype] = np.empty(size, dtype=dtype)
+        return buffer[:size].reshape(shape)
+
+    def __getstate__(self):
+        """buffers are not sent to other processes, every worker allocates its own"""
+        return {'buffers': {}}
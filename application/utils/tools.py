@@ -24,19 +24,48 @@ def iter_segments(subsegs):
         ge_prev = ge
 
 
-def slice_triggers_in_segment(triggers, gps_start, gps_end, pipeline):
-    if pipeline.NAME == 'local':
-        return slice(*np.searchsorted(triggers['GPStime'], (gps_start, gps_end)))
-    else:
-        return slice(*np.searchsorted(triggers, (gps_start, gps_end)))
-
-
-def count_triggers_in_segment(triggers, label, gps_start, gps_end, pipeline):
-    if pipeline.NAME == 'local':
-        i_start, i_end = np.searchsorted(triggers[triggers.label == label]['GPStime'], (gps_start, gps_end))
-    else:
-        i_start, i_end = np.searchsorted(triggers, (gps_start, gps_end))
-    return i_end - i_start
+def tree_reduce(items, merge):
+    """
+    reduces items pairwise as they come in, like a binary counter: two partial results are only merged if they
+    contain the same number of items. Each item takes part in O(log n) merges and at most O(log n) partial results
+    are kept in memory at a time.
+
+    :param items: iterable of items to reduce, e.g. results coming in from worker processes
+    :param merge: associative function that merges two partial results into one
+    :return: the reduced result, or None if there are no items
+    """
+    stack = []  # (number of items, partial result)
+    for item in items:
+        n = 1
+        while stack and stack[-1][0] == n:
+            n_other, other = stack.pop()
+            item = merge(other, item)
+            n += n_other
+        stack.append((n, item))
+
+    result = None
+    while stack:
+        _, other = stack.pop()
+        result = other if result is None else merge(other, result)
+    return result
+
+
+def slice_triggers_in_segment(triggers, gps_start, gps_end):
+    """
+    :param triggers: {label: sorted GPS times}
+    :return: {label: GPS times from gps_start to gps_end}
+    """
+    return {label: gps[slice(*np.searchsorted(gps, (gps_start, gps_end)))] for label, gps in triggers.items()}
+
+
+def count_triggers_in_segments(triggers, segments):
+    """
+    :param triggers: {label: sorted GPS times}
+    :param segments: list of (gps_start, gps_end)
+    :return: {label: number of triggers in every segment}
+    """
+    bounds = np.asarray([tuple(segment) for segment in segments], dtype=float).reshape(-1, 2)
+    return {label: np.diff(np.searchsorted(gps, bounds), axis=1)[:, 0] for label, gps in triggers.items()}
 
 
 def check_extension(file_name, extension):
@@ -3,34 +3,40 @@
         1. Read .../resources/config.yaml
         2. (if applicable) downsample data
         3. Load triggers
-        4. Either (a) load existing data (.pickle) or (b) run model on new data
+        4. Either (a) load existing histograms from the histogram store or (b) run model on segments that are not stored
             4b.1 apply transformations
             4b.2 load (transformed) data into histograms
         5. Calculate KS distance for each channel and (if applicable) bootstrap
         6. Generate report with results
 """
 
+import hashlib
+import json
+import multiprocessing as mp
 import os
-import pickle
 import sys
 
+import ligo.segments
 import numpy as np
 from tqdm import tqdm
 
 from application.config import config_manager
 from application.handler.data.reader.ffl import FrameFileReader
-from application.handler.data.reader.h5 import H5Reader
+from application.handler.data.channel_catalog import ChannelCatalog
+from application.handler.data.histogram_store import HistogramStore
+from application.handler.data.reader.h5 import H5Reader, ConsolidatedH5Reader, MemoryMappedH5Reader
 from application.handler.data.resampler import Resampler
 from application.handler.data.writer import DataWriter
 from application.handler.triggers import LocalPipeline, Omicron
 from application.model.ffl_cache import FFLCache
 from application.model.fom import KolmogorovSmirnov, AndersonDarling
-from application.model.histogram import Hist
-from application.model.transformation import do_transformations, GaussianDifferentiator, \
+from application.model.histogram import HistBank
+from application.model.transformation import TransformationTree, GaussianDifferentiator, \
     SavitzkyGolayDifferentiator, Differentiator, Abs, AbsMean
+from application.model.workspace import Workspace
 from application.plotting.plot import plot_histogram_cdf
 from application.plotting.report import HTMLReport
-from application.utils import count_triggers_in_segment, slice_triggers_in_segment, iter_segments
+from application.utils import count_triggers_in_segments, slice_triggers_in_segment, iter_segments, tree_reduce
 from resources.constants import CONFIG_FILE, RESOURCE_DIR
 
 LOG = config_manager.get_logger(__name__)
@@ -45,8 +51,13 @@ class Excavator:
         self.t_start = self.config['application.start_time']
         self.t_stop = self.config['application.end_time']
         self.f_target = self.config['application.target_frequency']
+        self.n_processes = self.config['application.n_processes']
+        self.layout = self.config['application.layout']
+        self.prefetch_segments = self.config['application.prefetch_segments']
+        self.channel_batch_size = self.config['application.channel_batch_size']
         with open(self.config['application.blacklist_patterns'], 'r') as f:
             bl_patterns: list = f.read().splitlines()
+        self.bl_patterns = bl_patterns
 
         if self.config['application.decimate']:
             LOG.info(f"Downsampling data to {self.f_target}Hz.")
@@ -54,14 +65,18 @@ class Excavator:
 
         if self.config['application.pipeline'] == 'omicron':
             self.trigger_pipeline = Omicron(channel=self.config['application.channel'], snr_threshold=self.config['application.snr_threshold'])
+            trigger_source = f"{self.config['application.channel']}_snr{self.config['application.snr_threshold']}"
         else:
             self.trigger_pipeline = LocalPipeline(trigger_file=self.config['application.trigger_file'])
+            trigger_source = os.path.splitext(os.path.basename(self.config['application.trigger_file']))[0]
         self.labels = self.trigger_pipeline.labels
 
         if self.source == 'local':
-            self.reader = H5Reader(gps_start=self.t_start,
-                                   gps_end=self.t_stop,
-                                   exclude_patterns=bl_patterns)
+            reader = {Resampler.CHANNEL_MAJOR: ConsolidatedH5Reader,
+                      Resampler.MEMORY_MAPPED: MemoryMappedH5Reader}.get(self.layout, H5Reader)
+            self.reader = reader(gps_start=self.t_start,
+                                 gps_end=self.t_stop,
+                                 exclude_patterns=bl_patterns)
         else:
             self.reader = FrameFileReader(source=self.source,
                                           gps_start=self.t_start,
@@ -70,85 +85,64 @@ class Excavator:
         self.n_points = int(round(abs(self.reader.segments[0]) * self.f_target))
         self.writer = DataWriter()
         self.report = HTMLReport()
-        self.histogram_file = RESOURCE_DIR + 'histograms.pickle'
+        data_source = f'local_f{self.f_target}' if self.source == 'local' else os.path.splitext(os.path.basename(self.source))[0]
+        self.histogram_path = RESOURCE_DIR + \
+            f'histograms/{data_source}_{self.layout}/f{self.f_target}_{self.trigger_pipeline.NAME}_{trigger_source}/'
+        self.histogram_store = None
+        self.catalog = ChannelCatalog(file=RESOURCE_DIR + f'catalog/{data_source}.h5')
 
         self.available_channels = None
         self.cum_aux_veto = None
         self.cum_trig_veto = None
         self.transformation_names = None
+        self.transformation_tree = None
         self.transformation_states = None
+        self.lookahead = 0
+        self.channel_rows = None
+        self.workspace = Workspace()
         self.transformation_combinations = None
+        self.block_duration = None
         self.h_aux_cum = None
         self.h_trig_cum = None
         self.i_trigger = None
+        self.trigger_codes = None
+        self.channel_status = {}
 
         if self.config['application.run']:
             self.run(load_existing=self.config['application.load_existing'], bootstrap=self.config['application.bootstrap'])
 
     def run(self, n_iter=1, load_existing=True, bootstrap=False):
 
-        self.available_channels = self.reader.get_available_channels()
+        self._discover_channels(self.reader.segments)
+        self.available_channels = self.catalog.get_channels(self.reader.segments, f_target=self.f_target,
+                                                            exclude_patterns=self.bl_patterns)
         LOG.info(f'Found {len(self.available_channels)} available channels.')
 
-        triggers = self.trigger_pipeline.get_segment(gps_start=self.t_start, gps_end=self.t_stop)
-        if triggers.size == 0:
+        triggers = self.trigger_pipeline.get_labelled_segment(gps_start=self.t_start, gps_end=self.t_stop)
+        if sum(label_triggers.size for label_triggers in triggers.values()) == 0:
             LOG.error(f"No triggers found between {self.t_start} and {self.t_stop}, aborting...")
             sys.exit(1)
 
         self.init_transformations()
 
-        test_file = f'test_{self.t_start}_{self.t_stop}_f{self.f_target}.pickle'
-        if load_existing and os.path.exists(test_file):
-            LOG.info("Loading existing histogram data...")
-            with open(test_file, 'rb') as pkf:
-                data = pickle.load(pkf)
-                self.h_trig_cum = data['trig']
-                self.h_aux_cum = data['aux']
-                self.available_channels = data['channels']
-        else:
-            if load_existing:
-                LOG.info(f"No existing data was found from {self.t_start} to {self.t_stop}.")
-            LOG.info("Generating new histogram data...")
-            self.construct_histograms(segments=self.reader.segments, triggers=triggers)
-            with open(test_file, 'wb') as pkf:
-                pickle.dump({'trig': self.h_trig_cum, 'aux': self.h_aux_cum, 'channels': self.available_channels}, pkf)
+        self.construct_histograms(segments=self.reader.segments, triggers=triggers, load_existing=load_existing)
+        self.h_trig_cum.compact()
+
+        keys = [(channel, transformation_name)
+                for channel in self.available_channels for transformation_name in self.transformation_names
+                if (channel, transformation_name) in self.h_aux_cum]
+        h_trig_combined = HistBank(keys)
+        for label in self.labels:
+            h_trig_combined.merge(self.h_trig_cum, keys, [(*key, label) for key in keys])
+        h_trig_combined.compact()
 
         fom_ks = KolmogorovSmirnov()
         fom_ad = AndersonDarling()
-        h_trig_combined = {}
-        for channel in tqdm(self.available_channels, desc="Computing Results"):
-            for transformation_name in self.transformation_names:
-                try:
-                    h_aux = self.h_aux_cum[channel, transformation_name]
-                    h_trig = Hist(np.array([]))
-                    for label in self.labels:
-                        h_trig += self.h_trig_cum[channel, transformation_name, label]
-                    h_trig_combined[channel, transformation_name] = h_trig
-                    try:
-                        h_aux.align(h_trig)
-
-                        fom_ks.calculate(channel, transformation_name, h_aux, h_trig)
-                        fom_ad.calculate(channel, transformation_name, h_aux, h_trig)
-                    except (AssertionError, AttributeError) as e:
-                        LOG.debug(f'Exception caught trying to compute FOM for ({channel, transformation_name}): {e}')
-                        continue
-                except KeyError:
-                    continue
+        self.score_batch([fom_ks, fom_ad], keys, h_trig_combined, keys)
 
         fom_ks_labels = {label: KolmogorovSmirnov() for label in self.labels}
-        for channel in tqdm(self.available_channels, desc="Computing Results"):
-            for transformation_name in self.transformation_names:
-                for label in self.labels:
-                    h_aux = self.h_aux_cum[channel, transformation_name]
-                    h_trig = self.h_trig_cum[channel, transformation_name, label]
-                    try:
-                        h_aux.align(h_trig)
-
-                        fom_ks_labels[label].calculate(channel, transformation_name, h_aux, h_trig)
-                    except (AssertionError, AttributeError) as e:
-                        LOG.debug(
-                            f'Exception caught trying to compute FOM for ({channel, transformation_name}): {e}')
-                        continue
+        for label in tqdm(self.labels, desc="Computing Results"):
+            self.score_batch([fom_ks_labels[label]], keys, self.h_trig_cum, [(*key, label) for key in keys])
 
         LOG.info("Constructing report of results...")
         ks_table_cols = ['Channel', 'Transformation', 'KS', 'p-value']
@@ -169,18 +163,26 @@ class Excavator:
         self.writer.write_csv(ad_results, 'ad_results.csv', file_path=self.writer.default_path + 'results/')
 
         if bootstrap:
-            for label in self.labels:
-                if label in ('Low_Frequency_Burst', 'Low_Frequency_Lines', 'Scattered_Light'):
-                    fom_ks_bootstrap = KolmogorovSmirnov()
-                    for i, (k, v) in tqdm(enumerate(ks_results[label][0:3]), desc=f'Bootstrapping KS'):
-                        channel, transformation = k
-                        h_aux = self.h_aux_cum[channel, transformation]
-                        h_trig = self.h_trig_cum[channel, transformation, label]
-                        fom_ks_bootstrap.calculate(channel, transformation, h_aux, h_trig, bootstrap=True)
-
-                    ks_results_bootstrap = sorted(fom_ks_bootstrap.scores.items(), key=lambda f: f[1].d_n, reverse=True)
-                    for result in ks_results_bootstrap:
-                        LOG.info(f'Bootstrap KS Result | {label}: {result}')
+            # every label is bootstrapped with its own child of the run seed, so that labels get independent samples
+            label_seeds = np.random.SeedSequence(self.config['application.bootstrap_seed']).spawn(len(self.labels))
+            label_seeds = dict(zip(sorted(self.labels), label_seeds))
+            for label in tqdm(self.labels, desc='Bootstrapping KS'):
+                fom_ks_bootstrap = KolmogorovSmirnov(seed=label_seeds[label])
+                ranked_keys = [k for k, v in ks_results[label]]
+                for i in range(0, len(ranked_keys), fom_ks_bootstrap.BATCH_SIZE):
+                    block = ranked_keys[i:i + fom_ks_bootstrap.BATCH_SIZE]
+                    counts_aux, counts_trig, valid = self.h_aux_cum.aligned_counts(
+                        keys=block, other=self.h_trig_cum, other_keys=[(*key, label) for key in block])
+                    fom_ks_bootstrap.bootstrap_batch(keys=[key for key, v in zip(block, valid) if v],
+                                                     counts_aux=counts_aux[valid],
+                                                     counts_trig=counts_trig[valid],
+                                                     n_processes=self.n_processes)
+
+                ks_results_bootstrap = sorted(fom_ks_bootstrap.scores.items(), key=lambda f: f[1].d_n, reverse=True)
+                self.writer.write_csv(ks_results_bootstrap, f'ks_bootstrap_results_{label}.csv',
+                                      file_path=self.writer.default_path + 'results/')
+                for result in ks_results_bootstrap[0:3]:
+                    LOG.info(f'Bootstrap KS Result | {label}: {result}')
 
         ks_images_div = 'ks_images'
         self.report.add_tag(tag_type='div', tag_id=ks_images_div)
@@ -211,12 +213,34 @@ class Excavator:
             self.report.add_row_to_table(content=[channel, transformation, round(statistic, 3), f'{p_value:.2E}'],
                                          table_id=ks_table)
 
+    def _discover_channels(self, segments):
+        """adds the channels of the segments that the catalog does not know yet"""
+        unknown = self.catalog.get_unknown_segments(segments)
+        if unknown:
+            LOG.info(f'Discovering channels in {len(unknown)} segments.')
+            for segment in unknown:
+                self.catalog.add_segment_channels(segment, self.reader.get_segment_channels(segment))
+            self.catalog.save()
+
+    def score_batch(self, foms, keys, h_trig, trig_keys):
+        """scores the aux histograms of keys against the histograms of trig_keys in h_trig with the batched figures of
+        merit, in blocks to limit the memory used by the aligned histograms. Each block is aligned once for all foms."""
+        batch_size = min(fom.BATCH_SIZE for fom in foms)
+        for i in range(0, len(keys), batch_size):
+            block = keys[i:i + batch_size]
+            counts_aux, counts_trig, valid = self.h_aux_cum.aligned_counts(
+                keys=block, other=h_trig, other_keys=trig_keys[i:i + batch_size])
+            for fom in foms:
+                fom.calculate_batch(keys=[key for key, v in zip(block, valid) if v],
+                                    counts_aux=counts_aux[valid],
+                                    counts_trig=counts_trig[valid])
+
     def generate_report(self):
         LOG.info("Generating HTML Report...")
         self.report.run_html()
 
     def decimate_data(self):
-        decimator = Resampler(f_target=self.f_target, method='mean')
+        decimator = Resampler(f_target=self.f_target, method='mean', layout=self.layout)
         aux_data = FFLCache(ffl_file=self.source, gps_start=self.t_start, gps_end=self.t_stop)
         decimator.downsample_ffl(ffl_cache=aux_data)
 
@@ -239,106 +263,398 @@ class Excavator:
 
         join_names = lambda c: '_'.join(t.NAME for t in c)
         self.transformation_names = [join_names(t) for t in self.transformation_combinations]
-        self.transformation_states = {
-            channel: {self.transformation_names[i]: t for i, t in enumerate(self.transformation_combinations)}
-            for channel in self.available_channels}
-
-        for channel in self.available_channels:
-            for name, transformations in self.transformation_states[channel].items():
-                for i, transformation in enumerate(transformations):
-                    if isinstance(transformation, type):
-                        self.transformation_states[channel][name][i] = transformation(mean=0.0000110343)
+        # combinations that share a prefix calculate it once. The transformations keep the state of every channel in
+        # the row of that channel.
+        transformation_kwargs = {'mean': 0.0000110343}
+        self.transformation_tree = TransformationTree(self.transformation_combinations)
+        self.transformation_states = self.transformation_tree.instantiate(n_channels=len(self.available_channels),
+                                                                          **transformation_kwargs)
+        # transformations that look ahead are given the start of the next block, so blocks are read one ahead
+        self.lookahead = max((t.lookahead for t in self.transformation_states), default=0)
+        self.channel_rows = {channel: i for i, channel in enumerate(self.available_channels)}
+
+        # data is streamed in blocks, unless a transformation needs all data of a segment at once
+        if all(t.STREAMING for combination in self.transformation_combinations for t in combination):
+            self.block_duration = self.config['application.block_duration']
+
+        settings = {
+            'transformations': self.transformation_tree.get_settings(**transformation_kwargs),
+            'outputs': self.transformation_tree.outputs,
+            'block_duration': self.block_duration,
+        }
+        settings_hash = hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+        self.histogram_store = HistogramStore(path=self.histogram_path, settings=settings_hash)
 
     def _init_cumulative_hists(self, segments, triggers):
-        self.cum_aux_veto = [np.zeros(self.n_points, dtype=bool) for _ in segments]
+        self.cum_aux_veto = [np.zeros(int(round(abs(segment) * self.f_target)), dtype=bool) for segment in segments]
 
-        self.cum_trig_veto = {
-            label: [np.zeros(count_triggers_in_segment(triggers, label, *segment, pipeline=self.trigger_pipeline), dtype=bool)
-                    for segment in segments]
-            for label in self.labels
-        }
+        counts = count_triggers_in_segments(triggers, segments)
+        self.cum_trig_veto = {label: [np.zeros(n, dtype=bool) for n in counts[label]] for label in self.labels}
 
-        self.h_aux_cum = {
-            (channel, transform): Hist(np.array([]))
+    def _init_histogram_banks(self):
+        """the trigger histograms hold few points in many rows, so they are kept compact"""
+        h_aux = HistBank(
+            (channel, transform)
             for channel in self.available_channels for transform in self.transformation_names
-        }
-        self.h_trig_cum = {
-            (channel, transform, label): Hist(np.array([]))
-            for channel in self.available_channels
-            for transform in self.transformation_names
-            for label in self.labels
-        }
-
-    def construct_histograms(self, segments, triggers) -> ({str, Hist}):
+        )
+        h_trig = HistBank(
+            ((channel, transform, label)
+             for channel in self.available_channels
+             for transform in self.transformation_names
+             for label in self.labels),
+            compact=True
+        )
+        return h_aux, h_trig
+
+    def construct_histograms(self, segments, triggers, load_existing=True) -> (HistBank, HistBank):
+        """
+        Histograms are made per segment, written to the histogram store and merged afterwards, which gives the same
+        result because merging histograms is associative. Segments that are already stored are loaded instead of
+        processed. With more than one process, runs of consecutive segments are processed in parallel and merged in
+        a tree as they come in.
+        """
         self._init_cumulative_hists(segments, triggers)
+        h_aux, h_trig = self._init_histogram_banks()
+        keys = {'aux': list(h_aux.keys()), 'trig': list(h_trig.keys())}
+
+        all_segments = list(iter_segments(segments))
+        stored = {segment for _, segment, _ in all_segments
+                  if load_existing and self.histogram_store.is_stored(segment, keys)}
+        todo = [(i, segment, gap) for i, segment, gap in all_segments if segment not in stored]
+        LOG.info(f'Found stored histograms for {len(stored)} out of {len(all_segments)} segments.')
+
+        discarded, statuses = [], {}
+        if todo:
+            LOG.info('Constructing histograms...')
+            n_processes = min(self.n_processes, len(todo))
+            tasks = []
+            for chunk in np.array_split(np.arange(len(todo)), n_processes):
+                chunk_segments = []
+                i_previous = None
+                for i_segment, segment, gap in (todo[j] for j in chunk):
+                    continues = i_segment - 1 == i_previous
+                    warm_up_segment = all_segments[i_segment - 1][1] if i_segment > 0 and not (gap or continues) else None
+                    chunk_segments.append((i_segment, segment, gap or not continues, warm_up_segment,
+                                           self._get_lookahead_segment(all_segments, i_segment)))
+                    i_previous = i_segment
+                tasks.append((chunk_segments, triggers))
+
+            if n_processes > 1:
+                LOG.info(f'Constructing histograms in {n_processes} processes.')
+                self.reader._reset_cache()
+                with mp.get_context('spawn').Pool(n_processes) as pool:
+                    h_aux, h_trig, discarded, statuses = tree_reduce(
+                        pool.imap_unordered(self._construct_chunk, tasks), merge=self._merge_chunks)
+            else:
+                h_aux, h_trig, discarded, statuses = self._construct_chunk(tasks[0])
+
+            for segment, segment_statuses in statuses.items():
+                self.catalog.set_status(segment, segment_statuses)
+            self.catalog.save()
+
+        if stored:
+            LOG.info('Loading stored histograms...')
+            stored = sorted(stored)
+            h_aux_stored, discarded_stored = self.histogram_store.load(stored, 'aux', keys['aux'])
+            h_trig_stored, _ = self.histogram_store.load(stored, 'trig', keys['trig'], compact=True)
+            h_aux += h_aux_stored
+            h_trig += h_trig_stored
+            discarded += [channel for channel in self.available_channels if str(channel) in discarded_stored]
+
+        self.h_aux_cum, self.h_trig_cum = h_aux, h_trig
+        for channel in discarded:
+            if channel in self.available_channels:
+                self._discard_channel(channel)
 
-        LOG.info('Constructing histograms...')
-        for i_segment, segment, gap in iter_segments(segments):
-            gps_start, gps_end = segment
-            if gap:
-                for combination in self.transformation_combinations:
-                    for transformation in combination:
-                        transformation.reset()
+    def _construct_chunk(self, task):
+        """constructs histograms for a list of segments, writes them to the histogram store per segment and returns
+        them merged, with the channels that were discarded on the way and the status of every channel per segment"""
+        chunk_segments, triggers = task
+        channels = list(self.available_channels)
+        h_aux, h_trig = self._init_histogram_banks()
+        statuses = {}
 
-            seg_triggers = triggers[slice_triggers_in_segment(triggers, gps_start, gps_end, pipeline=self.trigger_pipeline)]
-            self.i_trigger = {}
-            for label in self.labels:
-                if self.trigger_pipeline.NAME == self.trigger_pipeline.LOCAL:
-                    label_triggers = seg_triggers[seg_triggers.label == label]
-                    self.i_trigger[label] = np.floor((label_triggers.GPStime - gps_start) * self.f_target).astype(np.int32)
-                else:
-                    self.i_trigger[label] = np.floor((seg_triggers - gps_start) * self.f_target).astype(np.int32)
+        for i_segment, segment, reset, warm_up_segment, lookahead_segment in chunk_segments:
+            gps_start, gps_end = segment
+            if reset:
+                self._reset_transformations()
+            if warm_up_segment is not None:
+                self._warm_up_transformations(warm_up_segment)
+
+            seg_triggers = slice_triggers_in_segment(triggers, gps_start, gps_end)
+            self.i_trigger = {label: np.floor((seg_triggers[label] - gps_start) * self.f_target).astype(np.int32)
+                              for label in self.labels}
+            self.i_trigger, self.trigger_codes = self._merge_trigger_indices(i_segment)
+
+            segment_channels = list(self.available_channels)
+            self.channel_status = {}
+            self.h_aux_cum, self.h_trig_cum = self._init_histogram_banks()
+            batches = [segment_channels[j:j + self.channel_batch_size]
+                       for j in range(0, len(segment_channels), self.channel_batch_size)]
+            for batch in tqdm(batches, position=0, leave=True, desc=f'{segment[0]} -> {segment[1]}'):
+                if self.prefetch_segments:
+                    self.reader.prefetch(segment, batch)
+                self.update_histograms(i_segment, segment, batch, lookahead_segment)
+
+            segment_discarded = [channel for channel in segment_channels if channel not in self.available_channels]
+            statuses[segment] = self._get_channel_statuses(segment_channels)
+            self.histogram_store.write(segment, {'aux': self.h_aux_cum, 'trig': self.h_trig_cum}, segment_discarded)
+            h_aux += self.h_aux_cum
+            h_trig += self.h_trig_cum
+        self.reader._reset_cache()
+
+        discarded = [channel for channel in channels if channel not in self.available_channels]
+        return h_aux, h_trig, discarded, statuses
+
+    def _get_lookahead_segment(self, all_segments, i_segment):
+        """the start of the segment after segment i that transformations look ahead into, None after a gap"""
+        if not self.lookahead or i_segment + 1 == len(all_segments) or all_segments[i_segment + 1][2]:
+            return None
+        gps_start, gps_end = all_segments[i_segment + 1][1]
+        return ligo.segments.segment(gps_start, min(gps_end, gps_start + self.lookahead / self.f_target))
 
-            for channel in tqdm(self.available_channels, position=0, leave=True, desc=f'{segment[0]} -> {segment[1]}'):
-                self.update_channel_histogram(i_segment, segment, channel)
-            self.reader._reset_cache()
+    @staticmethod
+    def _merge_chunks(chunk, other):
+        h_aux, h_trig, discarded, statuses = chunk
+        h_aux += other[0]
+        h_trig += other[1]
+        statuses.update(other[3])
+        return h_aux, h_trig, discarded + other[2], statuses
+
+    def _get_channel_statuses(self, channels):
+        """catalog status of channels in the segment that was just processed, from the reason they were discarded or
+        else from the state of their untransformed histogram"""
+        kept = [channel for channel in channels if channel not in self.channel_status]
+        rows = self.h_aux_cum.rows([(channel, self.transformation_names[0]) for channel in kept])
+        status = np.select([self.h_aux_cum.isempty(rows), self.h_aux_cum.isconst(rows)],
+                           [ChannelCatalog.ALL_NAN, ChannelCatalog.CONSTANT], default=ChannelCatalog.PRESENT)
+        statuses = {str(channel): self.channel_status[channel] for channel in channels if channel in self.channel_status}
+        statuses.update(zip(map(str, kept), status.tolist()))
+        return statuses
+
+    def _reset_transformations(self, rows=None):
+        """resets the transformations of the channels in the given state rows, or of all channels"""
+        for transformation in self.transformation_states:
+            transformation.reset(rows)
+
+    def _warm_up_transformations(self, segment):
+        """runs the transformations over the segment before a chunk that does not start after a gap, so that stateful
+        transformations continue as if the segments were processed in one go"""
+        def iter_blocks(channel):
+            try:
+                yield from self.reader.iter_blocks(request_segment=segment, channel=channel,
+                                                   block_duration=self.block_duration)
+            except (UnicodeDecodeError, KeyError):
+                return
 
-    def _discard_channel(self, channel):
+        for j in range(0, len(self.available_channels), self.channel_batch_size):
+            batch = self.available_channels[j:j + self.channel_batch_size]
+            if self.prefetch_segments:
+                self.reader.prefetch(segment, batch)
+            for _, channels, blocks, following in self._iter_block_groups(batch, iter_blocks):
+                self._transform_blocks(channels, blocks, following=following)
+
+    def __getstate__(self):
+        """state that is sent to worker processes, the report is not needed there"""
+        state = self.__dict__.copy()
+        state['report'] = None
+        return state
+
+    def _merge_trigger_indices(self, i_segment):
+        """concatenates the non-vetoed trigger indices of all labels, with the position of each label in self.labels
+        as its code, so that the trigger histograms of all labels can be made in one pass"""
+        i_trigger = [self.i_trigger[label][~self.cum_trig_veto[label][i_segment]] for label in self.labels]
+        codes = np.repeat(np.arange(len(i_trigger)), [i.size for i in i_trigger])
+        return np.concatenate(i_trigger), codes
+
+    def _discard_channel(self, channel, status=ChannelCatalog.FAILED):
+        self.channel_status[channel] = status
         self.available_channels.remove(channel)
         for transform in self.transformation_names:
-            del self.h_aux_cum[channel, transform]
+            if (channel, transform) in self.h_aux_cum:
+                del self.h_aux_cum[channel, transform]
             for label in self.labels:
-                del self.h_trig_cum[channel, transform, label]
+                if (channel, transform, label) in self.h_trig_cum:
+                    del self.h_trig_cum[channel, transform, label]
 
-    def update_channel_histogram(self, i, segment, channel):
+    def _iter_channel_blocks(self, segment, channel):
+        """blocks of channel data in segment, the channel is discarded if it can not be read"""
         try:
-            x_aux = self.reader.get_data_from_segments(request_segment=segment, channel=channel)
+            yield from self.reader.iter_blocks(request_segment=segment, channel=channel,
+                                               block_duration=self.block_duration)
         except UnicodeDecodeError:
-            self._discard_channel(channel)
+            self._discard_channel(channel, status=ChannelCatalog.DECODE_FAILURE)
             LOG.debug(f'Discarded {channel} due to decoding error.')
-            return
-        if x_aux is None:
-            self._discard_channel(channel)
+        except KeyError:
+            self._discard_channel(channel, status=ChannelCatalog.MISSING)
             LOG.debug(f'Discarded {channel} due to disappearance.')
+
+    def _iter_lookahead_blocks(self, segment, channel):
+        """the blocks of channel in segment, which continues the segment that is processed without a gap"""
+        if segment is None:
+            return
+        try:
+            for block in self.reader.iter_blocks(request_segment=segment, channel=channel):
+                yield block._replace(contiguous=True)
+        except (UnicodeDecodeError, KeyError):
             return
-        for transformation_name in self.transformation_names:
-            x_transform = do_transformations(
-                transformations=self.transformation_states[channel][transformation_name],
-                data=x_aux)
-            try:
-                aux_hist = self.get_histogram(data=x_transform,
-                                              cumulative_veto=self.cum_aux_veto[i],
-                                              spanlike=self.h_aux_cum[channel, transformation_name])
-                self.h_aux_cum[channel, transformation_name] += aux_hist
-
-                for label, i_trigger in self.i_trigger.items():
-                    trig_hist = self.get_histogram(data=x_transform[i_trigger],
-                                                   cumulative_veto=self.cum_trig_veto[label][i],
-                                                   spanlike=aux_hist)
-                    self.h_trig_cum[channel, transformation_name, label] += trig_hist
-            except (OverflowError, AssertionError, IndexError) as e:
-                LOG.debug(f'Exception caught for channel {channel}: {e}, discarding.')
-                self._discard_channel(channel)
-                return
-            except KeyError:
-                LOG.debug(f'KeyError for {(channel, transformation_name)}, discarding.')
-                self.available_channels.remove(channel)
-                return
 
-    @staticmethod
-    def get_histogram(data, cumulative_veto, spanlike):
-        x_veto = data[~cumulative_veto]
-        return Hist(x_veto, spanlike=spanlike)
+    def _iter_block_groups(self, channels, iter_blocks, iter_blocks_after=None):
+        """
+        reads the blocks of channels side by side and groups the channels whose next blocks cover the same samples,
+        which is normally all of them. Channels are left out once they run out of blocks or are discarded. If the
+        transformations look ahead, every block is only yielded once the block after it is read.
+
+        :param iter_blocks: function that returns the blocks of a channel
+        :param iter_blocks_after: function that returns the blocks of a channel that follow the last of iter_blocks
+        :return: generator of (index of the first sample of the blocks, channels, blocks, the blocks that follow them
+            or None for the last blocks, which is only read if the transformations look ahead)
+        """
+        iterators = {channel: self._iter_with_following(iter_blocks(channel),
+                                                        iter_blocks_after(channel) if iter_blocks_after else ())
+                     for channel in channels}
+        i_start = dict.fromkeys(channels, 0)
+        while iterators:
+            groups = {}
+            for channel, blocks in list(iterators.items()):
+                block, following = next(blocks, (None, None))
+                if block is None or channel in self.channel_status:
+                    del iterators[channel]
+                else:
+                    groups.setdefault((i_start[channel], block.data.size), []).append((channel, block, following))
+            for (start, size), group in groups.items():
+                group_channels, blocks, following = zip(*group)
+                yield start, list(group_channels), list(blocks), list(following)
+                for channel in group_channels:
+                    i_start[channel] = start + size
+
+    def _iter_with_following(self, blocks, blocks_after=()):
+        """pairs every block with the block after it if the transformations look ahead, else with None. The last
+        block is followed by the first of blocks_after."""
+        if not self.lookahead:
+            yield from ((block, None) for block in blocks)
+            return
+        block = next(blocks, None)
+        while block is not None:
+            following = next(blocks, None)
+            yield block, following if following is not None else next(iter(blocks_after), None)
+            block = following
+
+    def _transform_blocks(self, channels, blocks, i_start=0, following=None):
+        """
+        transforms the blocks of channels as a single (channels, samples) block. Channels are reset first if their
+        block does not continue the previous one. Transformations that look ahead get the start of the following
+        blocks, padded with zeros where a following block is shorter, missing or not contiguous.
+
+        :return: (channels x transformations, samples) array with the transformed data of channel i and transformation
+            j in row i * len(transformation_names) + j. It is a workspace buffer, valid until the next block.
+        """
+        rows = np.array([self.channel_rows[channel] for channel in channels])
+        restart = np.array([i_start > 0 and not block.contiguous for block in blocks])
+        if restart.any():
+            self._reset_transformations(rows[restart])
+        n_samples = blocks[0].data.size
+        data = self.workspace.get('data', (len(blocks), n_samples))
+        for j, block in enumerate(blocks):
+            data[j] = block.data
+        lookahead = None
+        if self.lookahead:
+            lookahead = self.workspace.get('lookahead', (len(blocks), self.lookahead))
+            lookahead[:] = 0
+            for j, block in enumerate(following or ()):
+                if block is not None and block.contiguous:
+                    n = min(block.data.size, self.lookahead)
+                    lookahead[j, :n] = block.data[:n]
+        outputs = self.transformation_tree.calculate(self.transformation_states, data=data, rows=rows,
+                                                     workspace=self.workspace, lookahead=lookahead)
+        x_transform = self.workspace.get('x_transform', (len(blocks), len(outputs), n_samples))
+        for j, output in enumerate(outputs):
+            x_transform[:, j] = output
+        return x_transform.reshape(-1, n_samples)
+
+    def update_histograms(self, i, segment, channels, lookahead_segment=None):
+        """
+        fills the histograms of a batch of channels block by block, so that memory use is bounded by the block
+        size. The blocks of all channels are transformed and binned together. Blocks in which a channel is all NaN are
+        left out and its transformations restart after them as after a gap. The channel is only discarded if it has no
+        data in the whole segment. Transformations that look ahead past the last block read lookahead_segment.
+        """
+        nan_channels = set()
+        for i_start, block_channels, blocks, following in self._iter_block_groups(
+                channels, lambda channel: self._iter_channel_blocks(segment, channel),
+                lambda channel: self._iter_lookahead_blocks(lookahead_segment, channel)):
+            x_transform = self._transform_blocks(block_channels, blocks, i_start=i_start, following=following)
+            i_stop = i_start + blocks[0].data.size
+            mask = ~self.cum_aux_veto[i][i_start:i_stop]
+            all_nan = self._get_all_nan_channels(block_channels, x_transform, mask)
+            if all_nan.any():
+                nan_block_channels = [channel for channel, nan in zip(block_channels, all_nan) if nan]
+                nan_channels.update(nan_block_channels)
+                self._reset_transformations(np.array([self.channel_rows[channel] for channel in nan_block_channels]))
+                block_channels = [channel for channel, nan in zip(block_channels, all_nan) if not nan]
+                x_transform = x_transform.reshape(all_nan.size, -1, x_transform.shape[-1])[~all_nan]
+                x_transform = x_transform.reshape(-1, x_transform.shape[-1])
+                if not block_channels:
+                    continue
+            in_block = (self.i_trigger >= i_start) & (self.i_trigger < i_stop)
+            self._fill_histograms(block_channels, x_transform, mask=mask,
+                                  i_trigger=self.i_trigger[in_block] - i_start,
+                                  codes=self.trigger_codes[in_block])
+
+        for channel in nan_channels:
+            if channel in self.available_channels \
+                    and self.h_aux_cum.isempty(self.h_aux_cum.rows([(channel, self.transformation_names[0])]))[0]:
+                LOG.debug(f'Discarded {channel}, which has only NaNs in {segment}.')
+                self._discard_channel(channel, status=ChannelCatalog.ALL_NAN)
+
+    def _get_all_nan_channels(self, channels, x_transform, mask):
+        """:return: boolean array that tells for every channel if any of its transformations is NaN at all samples
+        selected by mask"""
+        if not mask.any():
+            return np.zeros(len(channels), dtype=bool)
+        all_nan = np.isnan(x_transform).all(axis=1, where=mask)
+        return all_nan.reshape(len(channels), -1).any(axis=1)
+
+    def _fill_histograms(self, channels, x_transform, mask, i_trigger, codes):
+        """fills the histograms of channels with their transformed data in one go. If that fails, they are filled
+        channel by channel to find and discard the channels that caused it."""
+        aux_keys = [(channel, t) for channel in channels for t in self.transformation_names]
+        try:
+            ind, l2_span = self.h_aux_cum.fill(keys=aux_keys, x=x_transform, mask=mask, workspace=self.workspace)
+        except (OverflowError, AssertionError, IndexError, KeyError) as e:
+            if len(channels) > 1:
+                for channel, rows in zip(channels, self._channel_slices(len(channels))):
+                    self._fill_histograms([channel], x_transform[rows], mask, i_trigger, codes)
+            elif isinstance(e, KeyError):
+                LOG.debug(f'KeyError for {channels[0]}, discarding.')
+                self.channel_status[channels[0]] = ChannelCatalog.FAILED
+                self.available_channels.remove(channels[0])
+            else:
+                LOG.debug(f'Exception caught for channel {channels[0]}: {e}, discarding.')
+                self._discard_channel(channels[0])
+            return
+        self._fill_trigger_histograms(channels, x_transform[:, i_trigger], codes,
+                                      ind=ind[:, i_trigger] if ind is not None else None, l2_span=l2_span)
+
+    def _fill_trigger_histograms(self, channels, x_trigger, codes, ind, l2_span):
+        """fills the trigger histograms of channels, of which the aux histograms were filled already"""
+        trig_keys = [[(channel, t, label) for label in self.labels]
+                     for channel in channels for t in self.transformation_names]
+        try:
+            self.h_trig_cum.fill_grouped(keys=trig_keys, x=x_trigger, codes=codes, ind=ind, l2_span=l2_span)
+        except (OverflowError, AssertionError, IndexError) as e:
+            if len(channels) > 1:
+                for channel, rows in zip(channels, self._channel_slices(len(channels))):
+                    self._fill_trigger_histograms([channel], x_trigger[rows], codes,
+                                                  ind=ind[rows] if ind is not None else None, l2_span=l2_span[rows])
+            else:
+                LOG.debug(f'Exception caught for channel {channels[0]}: {e}, discarding.')
+                self._discard_channel(channels[0])
+
+    def _channel_slices(self, n_channels):
+        """slices of the rows of every channel in data with a row per channel and transformation"""
+        n_transformations = len(self.transformation_names)
+        return [slice(j * n_transformations, (j + 1) * n_transformations) for j in range(n_channels)]
 
 
 if __name__ == '__main__':
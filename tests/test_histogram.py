@@ -0,0 +1,147 @@
+import numpy as np
+import pytest
+
+from application.model.histogram import Hist, HistBank
+
+
+def _fill_both(dense, compact, rng, keys, n_groups):
+    x = rng.normal(size=(len(keys), 500)) * rng.uniform(0.1, 100, size=(len(keys), 1))
+    x[0] = 3.  # constant row
+    mask = rng.random(500) > 0.2
+    codes = rng.integers(0, n_groups, 30)
+    results = []
+    for bank, trig in (dense, compact):
+        ind, l2_span = bank.fill(keys, x.copy(), mask=mask)
+        trig_keys = [[(*key, label) for label in range(n_groups)] for key in keys]
+        trig.fill_grouped(trig_keys, x[:, :30].copy(), codes=codes, ind=ind[:, :30], l2_span=l2_span)
+        results.append(trig)
+    return results
+
+
+def _assert_equal(a, b):
+    keys = list(a.keys())
+    assert keys == list(b.keys())
+    rows = a.rows(keys)
+    for field in HistBank.FIELDS:
+        np.testing.assert_array_equal(getattr(a, field)[rows], getattr(b, field)[rows])
+    np.testing.assert_array_equal(a._counts_of(rows), b._counts_of(rows))
+
+
+@pytest.mark.parametrize('n_segments', [1, 3])
+def test_compact_bank_fills_and_merges_like_dense(n_segments):
+    """trigger banks are filled and merged in compact form, which must give the same histograms as dense banks"""
+    rng = np.random.default_rng(1)
+    keys = [(channel, 'raw') for channel in 'abcd']
+    trig_keys = [(*key, label) for key in keys for label in range(3)]
+    total_dense, total_compact = HistBank(trig_keys), HistBank(trig_keys, compact=True)
+    for _ in range(n_segments):
+        dense = (HistBank(keys), HistBank(trig_keys))
+        compact = (HistBank(keys), HistBank(trig_keys, compact=True))
+        for _ in range(2):
+            h_trig_dense, h_trig_compact = _fill_both(dense, compact, rng, keys, n_groups=3)
+        total_dense += h_trig_dense
+        total_compact += h_trig_compact
+        assert h_trig_compact.iscompact
+
+    assert total_compact.iscompact
+    _assert_equal(total_dense, total_compact)
+    total_dense.check()
+    total_compact.check()
+
+
+def test_compact_bank_set_and_delete():
+    keys = ['a', 'b', 'c']
+    dense, compact = HistBank(keys), HistBank(keys, compact=True)
+    hist = Hist(np.random.default_rng(2).normal(size=1000))
+    for bank in (dense, compact):
+        bank['b'] = hist
+        bank['c'] = hist
+        del bank['c']
+    assert compact.iscompact
+    _assert_equal(dense, compact)
+    assert compact['b'] == hist
+
+    indptr, bins, values = compact.sparse_counts(compact.rows(['a', 'b']))
+    assert indptr[1] == 0 and values.sum() == hist.ntot
+    np.testing.assert_array_equal(np.bincount(bins, weights=values, minlength=compact.nbin), dense.counts[1])
+
+
+def _assert_same_hist(bank, key, hist):
+    """compares a row of bank with a Hist, bin by bin at absolute positions since the offsets may differ"""
+    row = bank[key]
+    assert row.ntot == hist.ntot
+    if hist.isempty:
+        return
+    assert (row.x_min, row.x_max) == (hist.x_min, hist.x_max)
+    assert row.isexpanded == hist.isexpanded
+    if hist.isexpanded:
+        assert (row.l2_span, row.i_min, row.i_max) == (hist.l2_span, hist.i_min, hist.i_max)
+        np.testing.assert_array_equal(np.flatnonzero(row.counts) + row.i_offset,
+                                      np.flatnonzero(hist.counts) + hist.i_offset)
+        np.testing.assert_array_equal(row.counts[row.counts > 0], hist.counts[hist.counts > 0])
+
+
+def _blocks(rng, n_keys, n_blocks, n=300):
+    """blocks with random widths and offsets, so that merged ranges often end just above a power of 2"""
+    for i in range(n_blocks):
+        x = rng.uniform(size=(n_keys, n)) * 2. ** rng.uniform(-3, 3, size=(n_keys, 1))
+        x += rng.uniform(-4, 4, size=(n_keys, 1))
+        x[0] = 3. + (i % 2)  # constant in every block, with two values
+        x[1, :] = i if i % 3 else x[1]  # constant in some blocks only
+        # halves of [0, 1 - 2**-12], which fits in span 0 although (1 - 2**-12) * (nbin + 2) / nbin > 1
+        x[2] = np.linspace(0, 0.5 - 2 ** -12, n) + 0.5 * (i % 2)
+        mask = rng.random(n) > 0.2
+        mask[[0, -1]] = True
+        yield x, mask, rng.integers(0, 3, n // 10)
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_bank_fills_like_hist(compact):
+    """fill and fill_grouped must give the same histograms as the per-channel Hist objects they replace"""
+    rng = np.random.default_rng(3)
+    keys = [(channel, 'raw') for channel in range(20)]
+    aux, trig = HistBank(keys), HistBank([(*key, label) for key in keys for label in range(3)], compact=compact)
+    h_aux = {key: Hist(np.zeros(0)) for key in keys}
+    h_trig = {(*key, label): Hist(np.zeros(0)) for key in keys for label in range(3)}
+    for x, mask, codes in _blocks(rng, len(keys), n_blocks=5):
+        ind, l2_span = aux.fill(keys, x.copy(), mask=mask)
+        trig.fill_grouped([[(*key, label) for label in range(3)] for key in keys], x[:, :codes.size].copy(),
+                          codes=codes, ind=None if ind is None else ind[:, :codes.size], l2_span=l2_span)
+        for i, key in enumerate(keys):
+            aux_hist = Hist(x[i, mask], spanlike=h_aux[key])
+            h_aux[key] += aux_hist
+            for label in range(3):
+                h_trig[(*key, label)] += Hist(x[i, :codes.size][codes == label], spanlike=aux_hist)
+
+    for key, hist in h_aux.items():
+        _assert_same_hist(aux, key, hist)
+    for key, hist in h_trig.items():
+        _assert_same_hist(trig, key, hist)
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_bank_merges_like_hist(compact):
+    """merging banks must give the same histograms as merging Hist objects one by one"""
+    rng = np.random.default_rng(4)
+    keys = list(range(20))
+    total, hists = HistBank(keys, compact=compact), {key: Hist(np.zeros(0)) for key in keys}
+    for x, _, _ in _blocks(rng, len(keys), n_blocks=5):
+        bank = HistBank(keys, compact=compact)
+        bank.fill(keys, x.copy())
+        total += bank
+        for i, key in enumerate(keys):
+            hists[key] += Hist(x[i])
+
+    for key, hist in hists.items():
+        _assert_same_hist(total, key, hist)
+    total.check()
+
+
+def test_shift_leaves_old_counts_alone():
+    hist = Hist(np.random.default_rng(5).normal(size=1000))
+    counts = hist.counts
+    before = counts.copy()
+    hist.shift(3)
+    np.testing.assert_array_equal(counts, before)
+    np.testing.assert_array_equal(hist.counts[hist.i_min - hist.i_offset:hist.i_max - hist.i_offset + 1],
+                                  before[hist.i_min - hist.i_offset + 3:hist.i_max - hist.i_offset + 4])
@@ -0,0 +1,38 @@
+import importlib.util
+import os
+
+import numpy as np
+import pytest
+
+# loaded from its file, since the fom package imports a module that is not part of this tree
+_spec = importlib.util.spec_from_file_location(
+    'kolgomorov_smirnov',
+    os.path.join(os.path.dirname(__file__), '..', 'application', 'model', 'fom', 'kolgomorov_smirnov.py'))
+kolgomorov_smirnov = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(kolgomorov_smirnov)
+KolmogorovSmirnov = kolgomorov_smirnov.KolmogorovSmirnov
+
+
+@pytest.mark.parametrize('n_trig', [30, 2000])
+def test_p_values_match_per_row(n_trig):
+    """the interpolation table must stay accurate when a single outlier distance is far in the tail"""
+    rng = np.random.default_rng(0)
+    n_rows = KolmogorovSmirnov.P_TABLE_MIN_COUNT + 200
+    n_aux = np.full(n_rows, 1e6)
+    n_trig = np.full(n_rows, n_trig)
+    d_n = rng.uniform(0, 4 / np.sqrt(n_trig[0]), n_rows)
+    d_n[0] = 0.9
+
+    p = KolmogorovSmirnov._get_p_values(d_n, n_aux, n_trig)
+
+    rows = np.r_[0, rng.choice(n_rows, 200, replace=False)]
+    expected = [KolmogorovSmirnov._get_p_value(d_n[i], n_aux[i], n_trig[i]) for i in rows]
+    np.testing.assert_allclose(p[rows], expected, rtol=0, atol=1e-3)
+
+
+def test_p_values_without_table():
+    d_n = np.array([0.0, 0.05, 0.2, 1.0])
+    n_aux = np.array([1000, 500, 2000, 100])
+    n_trig = np.array([100, 50, 20, 10])
+    expected = [KolmogorovSmirnov._get_p_value(*row) for row in zip(d_n, n_aux, n_trig)]
+    np.testing.assert_allclose(KolmogorovSmirnov._get_p_values(d_n, n_aux, n_trig), expected)
@@ -0,0 +1,84 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+from application.handler.triggers import omicron
+from application.handler.triggers.omicron import Omicron
+
+# stand-in for omicron-print: a trigger every 10 s before GPS 1000 with SNR 10 or 5, none after. Every call is logged.
+STAND_IN = """#!{python}
+import sys
+args = dict(arg.split('=', 1) for arg in sys.argv[1:])
+gps_start, gps_end = int(args['gps-start']), int(args['gps-end'])
+with open({log!r}, 'a') as log:
+    log.write(f'{{gps_start}} {{gps_end}}\\n')
+print('# time frequency snr')
+for t in range(gps_start, min(gps_end, 1000), 10):
+    print(t + 0.5, 100, 10 if t % 20 == 0 else 5)
+"""
+
+
+@pytest.fixture
+def stand_in(tmp_path, monkeypatch):
+    """:return: the stand-in executable and a function that returns the intervals fetched since it was last called"""
+    monkeypatch.setattr(omicron, 'RESOURCE_DIR', str(tmp_path) + '/')
+    monkeypatch.setattr(Omicron, 'FETCH_DURATION', 100)
+    log = tmp_path / 'calls.log'
+    executable = tmp_path / 'omicron-print'
+    executable.write_text(STAND_IN.format(python=sys.executable, log=str(log)))
+    os.chmod(executable, 0o755)
+
+    def pop_calls():
+        calls = sorted(tuple(map(int, line.split())) for line in log.read_text().splitlines()) if log.exists() else []
+        log.unlink(missing_ok=True)
+        return calls
+    return str(executable), pop_calls
+
+
+def test_only_gaps_are_fetched(stand_in):
+    executable, pop_calls = stand_in
+    gps = Omicron('V1:X', snr_threshold=6, executable=executable, n_fetch=2).get_segment(0, 200)
+    assert pop_calls() == [(0, 100), (100, 200)]
+    np.testing.assert_array_equal(gps, np.arange(0, 200, 20) + 0.5)
+
+    # a new pipeline reads the cache from disk and only fetches what is not in it
+    gps = Omicron('V1:X', snr_threshold=6, executable=executable).get_segment(150, 300)
+    assert pop_calls() == [(200, 300)]
+    np.testing.assert_array_equal(gps, np.arange(160, 300, 20) + 0.5)
+
+    Omicron('V1:X', executable=executable).get_segment(0, 300)
+    assert pop_calls() == []
+
+
+def test_intervals_without_triggers_are_cached(stand_in):
+    executable, pop_calls = stand_in
+    assert Omicron('V1:X', executable=executable).get_segment(1000, 1100).size == 0
+    assert pop_calls() == [(1000, 1100)]
+    assert Omicron('V1:X', executable=executable).get_segment(1000, 1100).size == 0
+    assert pop_calls() == []
+
+
+def test_snr_cut_applies_to_cached_triggers(stand_in):
+    executable, pop_calls = stand_in
+    assert Omicron('V1:X', snr_threshold=6, executable=executable).get_segment(0, 100).size == 5
+    assert Omicron('V1:X', executable=executable).get_segment(0, 100).size == 10
+    assert Omicron('V1:X', snr_threshold=20, executable=executable).get_segment(0, 100).size == 0
+    assert pop_calls() == [(0, 100)]
+
+
+def test_adjacent_intervals_are_merged(stand_in):
+    executable, pop_calls = stand_in
+    for gps_start, gps_end in [(0, 100), (300, 400), (1000, 1100)]:
+        Omicron('V1:X', executable=executable).get_segment(gps_start, gps_end)
+    pipeline = Omicron('V1:X', executable=executable)
+    np.testing.assert_array_equal(pipeline.cache.intervals, [[0, 100], [300, 400], [1000, 1100]])
+
+    pop_calls()
+    gps = pipeline.get_segment(50, 1050)
+    assert pop_calls() == [(100, 200), (200, 300), (400, 500), (500, 600), (600, 700), (700, 800), (800, 900),
+                           (900, 1000)]
+    np.testing.assert_array_equal(pipeline.cache.intervals, [[0, 1100]])
+    np.testing.assert_array_equal(gps, np.arange(50, 1000, 10) + 0.5)
+    assert np.unique(gps).size == gps.size
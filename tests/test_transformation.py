@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('matplotlib')  # imported by the transformation module
+from application.model.transformation import Abs, GaussianDifferentiator, TransformationTree  # noqa: E402
+
+
+def _iter_blocks(x, stops):
+    """blocks of x split at stops, with the start of the next block as look-ahead"""
+    starts = [0, *stops]
+    for start, stop in zip(starts, [*stops, x.shape[-1]]):
+        yield x[:, start:stop], x[:, stop:stop + 50] if stop < x.shape[-1] else None
+
+
+@pytest.mark.parametrize('stops', [[], [100], [60, 180, 230]])
+def test_gauss_filters_contiguous_blocks_as_one_signal(stops):
+    """the tail and the look-ahead must give the result of filtering all data at once, wherever the blocks are split,
+    as long as blocks are at least half the kernel long"""
+    x = np.random.default_rng(0).normal(size=(3, 300))
+    gauss = GaussianDifferentiator(n_points=100)
+    assert gauss.lookahead == 49
+    gauss.init_state(n_channels=4)
+    rows = np.array([3, 0, 1])
+    blocks = [gauss.calculate(block, rows=rows, lookahead=ahead) for block, ahead in _iter_blocks(x, stops)]
+
+    expected = [np.convolve(channel, gauss.kernel, mode='same') for channel in x]
+    np.testing.assert_allclose(np.concatenate(blocks, axis=-1), expected, atol=1e-12)
+
+
+def test_gauss_restarts_after_reset():
+    x = np.random.default_rng(1).normal(size=(2, 200))
+    gauss = GaussianDifferentiator(n_points=80)
+    gauss.init_state(n_channels=2)
+    gauss.calculate(x[:, :100])
+    gauss.reset()
+    np.testing.assert_allclose(gauss.calculate(x[:, 100:]),
+                               [np.convolve(channel, gauss.kernel, mode='same') for channel in x[:, 100:]],
+                               atol=1e-12)
+
+
+def test_tree_passes_lookahead_to_first_transformations():
+    gauss = GaussianDifferentiator(n_points=100)
+    tree = TransformationTree([[], [gauss], [gauss, Abs]])
+    transformations = tree.instantiate(n_channels=1)
+    x = np.random.default_rng(2).normal(size=(1, 200))
+    outputs = [tree.calculate(transformations, data=block, lookahead=ahead) for block, ahead in _iter_blocks(x, [120])]
+
+    expected = np.convolve(x[0], gauss.kernel, mode='same')
+    np.testing.assert_allclose(np.concatenate([gauss_output for _, gauss_output, _ in outputs], axis=-1)[0], expected,
+                               atol=1e-12)
+    np.testing.assert_allclose(np.concatenate([abs_output for _, _, abs_output in outputs], axis=-1)[0],
+                               np.abs(expected), atol=1e-12)
+
+    with pytest.raises(AssertionError):
+        TransformationTree([[Abs, gauss]]).instantiate(n_channels=1)